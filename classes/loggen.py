@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Генератор синтетических логов сервера в формате, который разбирают
+logs/parser.py и classes/parser.py. Адреса страниц, браузеры и клиенты
+выбираются по закону Ципфа, у части строк нет времени загрузки, часть строк
+испорчена. При одинаковых параметрах и seed вывод одинаков.
+Использование: loggen.py [-n строк] [--seed число] [...] > файл
+"""
+from datetime import datetime, timedelta
+from itertools import accumulate
+import argparse
+import random
+import sys
+
+METHODS = ('GET', 'GET', 'GET', 'POST', 'HEAD', 'PUT', 'OPTIONS', 'DELETE')
+START = datetime(2013, 2, 17, 6, 37, 31)
+
+
+def zipf_weights(count: int, exponent: float) -> list:
+    """Возвращает накопленные веса распределения Ципфа для count
+    элементов, пригодные для random.choices(cum_weights=...)."""
+    return list(accumulate(1 / rank ** exponent
+                           for rank in range(1, count + 1)))
+
+
+def make_agent(rng: random.Random, number: int) -> str:
+    """Придумывает строку браузера; среди них есть строки с кавычками и
+    пробелами, как у настоящих браузеров."""
+    kind = rng.randrange(4)
+    if kind == 0:
+        return 'Mozilla/5.0 (X11; Linux x86_64; rv:%d.0) Gecko/20100101 ' \
+               'Firefox/%d.0' % (number % 60, number)
+    if kind == 1:
+        return 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.%d ' \
+               '(KHTML, like Gecko) Chrome/%d.0' % (number % 40, number)
+    if kind == 2:
+        return 'bot-%d/1.0 (+"http://bots.example/%d")' % (number, number)
+    return 'curl/7.%d.%d' % (number % 70, number % 10)
+
+
+def malformed(rng: random.Random, line: str) -> str:
+    """Портит корректную строку лога одним из типичных способов так, что
+    она гарантированно не проходит разбор: строка обрывается до адреса
+    перехода, из запроса пропадает закрывающая кавычка, год меняется на
+    19xx, метод — на неизвестный, пропадает один из дефисов или строка
+    заменяется мусором."""
+    kind = rng.randrange(6)
+    if kind == 0:
+        return line[:rng.randrange(1, line.index(' "http'))]
+    if kind == 1:
+        return line.replace(' HTTP/1.1" ', ' HTTP/1.1 ', 1)
+    if kind == 2:
+        return line.replace('/20', '/19', 1)
+    if kind == 3:
+        prefix, _, rest = line.partition('] "')
+        return prefix + '] "FETCH' + rest[rest.index(' '):]
+    if kind == 4:
+        return line.replace(' - - [', ' - [', 1)
+    return 'garbage %d' % rng.randrange(10 ** 6)
+
+
+def generate(lines: int, seed: int = 2013, pages: int = 10000,
+             agents: int = 500, clients: int = 5000, exponent: float = 1.1,
+             missing_time: float = 0.1, malformed_lines: float = 0.02) -> iter:
+    """Генератор lines строк лога (без переводов строк). pages, agents и
+    clients — число различных страниц, браузеров и клиентов, exponent —
+    показатель распределения Ципфа, missing_time и malformed_lines — доли
+    строк без времени загрузки и испорченных строк. Время в строках
+    возрастает на 0–2 секунды, так что лог охватывает несколько дней."""
+    rng = random.Random(seed)
+    urls = ['/page/%d' % number if number % 7 else
+            '/search?q=%d&page=%d' % (number, number % 13)
+            for number in range(pages)]
+    agent_names = [make_agent(rng, number) for number in range(agents)]
+    addresses = ['%d.%d.%d.%d' % (rng.randrange(1, 224), rng.randrange(256),
+                                  rng.randrange(256), rng.randrange(1, 255))
+                 for _ in range(clients)]
+    url_weights = zipf_weights(pages, exponent)
+    agent_weights = zipf_weights(agents, exponent)
+    client_weights = zipf_weights(clients, exponent)
+
+    moment = START
+    for _ in range(lines):
+        moment += timedelta(seconds=rng.randrange(3))
+        time = '' if rng.random() < missing_time else \
+            ' %d' % int(rng.lognormvariate(9, 1.5))
+        line = '%s - - [%s +0600] "%s %s HTTP/1.1" %d %d "%s" "%s"%s' % (
+            rng.choices(addresses, cum_weights=client_weights)[0],
+            moment.strftime('%d/%b/%Y:%H:%M:%S'), rng.choice(METHODS),
+            rng.choices(urls, cum_weights=url_weights)[0],
+            rng.choice((200, 200, 200, 304, 404, 500)),
+            rng.randrange(100, 100000), 'http://192.168.65.101/',
+            rng.choices(agent_names, cum_weights=agent_weights)[0], time)
+        if rng.random() < malformed_lines:
+            line = malformed(rng, line)
+        yield line
+
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Генератор синтетических логов сервера.')
+    arguments.add_argument('-n', '--lines', type=int, default=100000,
+                           help='число строк')
+    arguments.add_argument('--seed', type=int, default=2013)
+    arguments.add_argument('--pages', type=int, default=10000,
+                           help='число различных страниц')
+    arguments.add_argument('--agents', type=int, default=500,
+                           help='число различных браузеров')
+    arguments.add_argument('--clients', type=int, default=5000,
+                           help='число различных клиентов')
+    arguments.add_argument('--exponent', type=float, default=1.1,
+                           help='показатель распределения Ципфа')
+    arguments.add_argument('--missing-time', type=float, default=0.1,
+                           help='доля строк без времени загрузки')
+    arguments.add_argument('--malformed', type=float, default=0.02,
+                           help='доля испорченных строк')
+    args = arguments.parse_args()
+
+    for line in generate(args.lines, args.seed, args.pages, args.agents,
+                         args.clients, args.exponent, args.missing_time,
+                         args.malformed):
+        sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
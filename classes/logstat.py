@@ -0,0 +1,1807 @@
+#!/usr/bin/env python3
+"""
+Общее ядро разбора и подсчёта статистики логов сервера. На нём построены
+logs/parser.py (консольная утилита) и classes/parser.py; результаты
+выводятся через приёмники TextSink, DictSink и JsonSink.
+"""
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from itertools import compress, islice
+from operator import truediv
+from socket import inet_ntop, inet_pton, AF_INET
+import bz2
+import copy
+import gzip
+import hashlib
+import heapq
+import json
+import lzma
+import math
+import mmap
+import os
+import pickle
+import queue
+import re
+import struct
+import sys
+import threading
+import time
+
+
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+DAY_CACHE_SIZE = 4096
+CHECKPOINT_VERSION = 3
+CHECKPOINT_LINES = 10000
+READ_BLOCK = 1 << 20
+READ_QUEUE = 8
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open,
+           '.lzma': lzma.open}
+PERCENTILES = (50, 95, 99)
+SKETCH_ERROR = 0.001
+SKETCH_CONFIDENCE = 0.99
+HEAVY_HITTERS = 32
+HLL_PRECISION = 12
+CACHE_SUFFIX = '.parsed'
+NON_ASCII = re.compile(rb'[\x80-\xff]')
+CACHE_MAGIC = b'LOGCOLS' + sys.byteorder[:1].encode()
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct('<8sIQqQ')
+CACHE_SECTIONS = ('urls', 'agent_names', 'addresses', 'irregular', 'ips',
+                  'ip_mask', 'clients', 'days', 'seconds', 'pages', 'agents',
+                  'times', 'time_mask')
+
+
+class Parser(object):
+    """
+    Класс парсера для обработки файла с логами.
+    """
+    def __init__(self, incremental: bool = False,
+                 percentiles: bool = False,
+                 approximate: bool = False, error: float = SKETCH_ERROR,
+                 precision: int = HLL_PRECISION,
+                 instrumented: bool = False) -> None:
+        """Инициализация класса. В режиме incremental самая медленная в
+        среднем страница и лучшие клиенты по дням поддерживаются по мере
+        поступления строк, и results() обрабатывает только то, что
+        изменилось с прошлого вызова. Флаг percentiles включает подсчёт
+        перцентилей времени загрузки каждой страницы (см. LatencySketch).
+
+        В режиме approximate память не зависит от числа различных страниц,
+        браузеров и клиентов: популярность считается в CountMinTop с
+        ошибкой error (в долях от числа строк), а число различных клиентов
+        по дням — в HyperLogLog с 2 ** precision регистрами. Самая медленная
+        в среднем страница ищется среди самых популярных.
+
+        Флаг instrumented включает сбор метрик работы парсера (см.
+        instrument)."""
+        if approximate and (incremental or percentiles):
+            raise ValueError('approximate mode is incompatible with '
+                             'incremental and percentiles modes')
+        self.incremental = incremental
+        self.percentiles = percentiles
+        self.approximate = approximate
+        self.error = error
+        self.precision = precision
+
+        self.slowest_page = ''
+        self.slowest_page_time = 0
+
+        self.slowest_average_page = ''
+
+        self.fastest_page = ''
+        self.fastest_page_time = math.inf
+
+        self.latencies = {}
+
+        self.urls = StringTable()
+        self.agents = StringTable()
+        self.addresses = AddressTable()
+        self.page_times = array('Q')
+        self.days = {}
+        self.column_tables = None
+
+        if approximate:
+            self.most_popular_pages = CountMinTop(error)
+            self.most_popular_agents = CountMinTop(error)
+            self.most_active_clients = CountMinTop(error)
+            self.page_time_sketch = CountMinSketch(error)
+            self.day_clients = {}
+        else:
+            self.most_popular_pages = DenseTop(self.urls.name)
+            self.most_popular_agents = DenseTop(self.agents.name)
+            self.most_active_clients = DenseTop(self.addresses.name)
+
+        self.averages = []
+        self.changed_pages = set()
+        self.changed_days = set()
+        self.day_results = {}
+        self.windows = []
+
+        self.pattern = re.compile(r'(?P<ip>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+                                  r' - - \[(?P<date>\d{2}/(Jan|Feb|Mar|Apr|'
+                                  r'May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)/20\d{2}):'
+                                  r'(?P<clock>[0-2][0-9]:[0-5]\d:[0-5]\d) '
+                                  r'\+\d{4}] "(GET|PUT|POST|HEAD|OPTIONS|'
+                                  r'DELETE) (?P<url>\S+) \S+" \d+ \d+ "\S+" '
+                                  r'"(?P<browser>.+)"( (?P<time>\d+)|)')
+        self.byte_pattern = re.compile(self.pattern.pattern.encode())
+        self.date_names = {}
+        self.day_ordinals = {}
+
+        self.metrics = None
+        if instrumented:
+            self.instrument()
+
+    def instrument(self) -> 'Metrics':
+        """Включает сбор метрик и возвращает их. Методы разбора строк,
+        подсчёта статистики, интернирования, перевода дат и счётчиков топов
+        (в том числе топов по дням, которые создаются по мере появления
+        дней, — их время суммируется в таймере top_days) подменяются у
+        этого экземпляра обёртками, которые считают вызовы и время, поэтому
+        без instrument() парсер работает как прежде.
+        Отвергнутые строки считаются в extract_info (add_buffer вызывает его
+        только для строк с не-ASCII символами), число различных ключей
+        вычисляется при экспорте."""
+        if self.metrics is not None:
+            return self.metrics
+        metrics = self.metrics = Metrics()
+
+        extract_info = metrics.timed('extract_info', self.extract_info)
+
+        def counted_extract_info(s: str) -> (None, dict):
+            info = extract_info(s)
+            metrics.count('lines_rejected' if info is None
+                          else 'lines_accepted')
+            return info
+
+        self.extract_info = counted_extract_info
+        for name in ('update_stats', 'add_page', 'day_ordinal'):
+            setattr(self, name, metrics.timed(name, getattr(self, name)))
+        for name in ('urls', 'agents', 'addresses'):
+            table = getattr(self, name)
+            if hasattr(table, 'intern'):
+                table.intern = metrics.timed('intern_' + name, table.intern)
+        for name in ('most_popular_pages', 'most_popular_agents',
+                     'most_active_clients'):
+            top = getattr(self, name)
+            top.add = metrics.timed('top_' + name, top.add)
+        for top in self.days.values():
+            top.add = metrics.timed('top_days', top.add)
+        new_day_top = self.new_day_top
+
+        def timed_new_day_top():
+            top = new_day_top()
+            top.add = metrics.timed('top_days', top.add)
+            return top
+
+        self.new_day_top = timed_new_day_top
+
+        metrics.gauge('keys', {'table': 'urls'},
+                      lambda: len(self.urls.names))
+        metrics.gauge('keys', {'table': 'agents'},
+                      lambda: len(self.agents.names))
+        metrics.gauge('keys', {'table': 'addresses'},
+                      lambda: len(self.addresses.ids))
+        metrics.gauge('keys', {'table': 'days'}, lambda: len(self.days))
+        return metrics
+
+    def __getstate__(self) -> dict:
+        """При сериализации (контрольные точки, пул процессов) обёртки
+        instrument() и метрики отбрасываются: восстановленный парсер
+        работает без метрик."""
+        state = self.__dict__.copy()
+        if self.metrics is not None:
+            state['metrics'] = None
+            for name in ('extract_info', 'update_stats', 'add_page',
+                         'day_ordinal', 'new_day_top'):
+                del state[name]
+            for name in ('most_popular_pages', 'most_popular_agents',
+                         'most_active_clients'):
+                state[name] = copy.copy(state[name])
+                del state[name].add
+            state['days'] = {day: copy.copy(top)
+                             for day, top in self.days.items()}
+            for top in state['days'].values():
+                del top.add
+        return state
+
+    def new_day_top(self):
+        """Создаёт топ клиентов для нового дня."""
+        if self.approximate:
+            return CountMinTop(self.error)
+        return LexicographicTop(self.addresses.name)
+
+    def parse(self) -> None:
+        """Основная функция обработки логов."""
+        for line in sys.stdin:
+            self.add_line(line)
+
+        self.find_slowest_average()
+
+    def parse_mmap(self, filename: str) -> None:
+        """Обработка файла с логами, отображённого в память."""
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    self.add_buffer(buf, 0, len(buf))
+
+        self.find_slowest_average()
+
+    def parse_file(self, filename: str, jobs: int = None,
+                   use_mmap: bool = False) -> None:
+        """Параллельная обработка файла с логами. Файл делится на участки,
+        выровненные по границам строк, каждый участок обрабатывается отдельным
+        процессом, после чего результаты объединяются в порядке следования
+        участков в файле. Участки разбираются в том же режиме, что и этот
+        парсер (см. shard_options)."""
+        options = self.shard_options()
+        ranges = split_file(filename, jobs or os.cpu_count())
+        starts = [start for start, _ in ranges]
+        ends = [end for _, end in ranges]
+
+        with ProcessPoolExecutor(max_workers=len(ranges) or 1) as pool:
+            for shard in pool.map(parse_range, [filename] * len(ranges),
+                                  starts, ends, [use_mmap] * len(ranges),
+                                  [options] * len(ranges)):
+                self.merge(shard)
+
+        self.find_slowest_average()
+
+    def parse_files(self, filenames: list, jobs: int = None) -> None:
+        """Обработка нескольких файлов с логами, в том числе сжатых. Каждый
+        файл обрабатывается отдельным процессом, результаты объединяются в
+        порядке перечисления файлов (см. shard_options)."""
+        jobs = min(jobs or os.cpu_count(), len(filenames))
+        if jobs <= 1:
+            for filename in filenames:
+                with open_log(filename) as f:
+                    self.parse_stream(f)
+        else:
+            options = self.shard_options()
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                for shard in pool.map(parse_log, filenames,
+                                      [options] * len(filenames)):
+                    self.merge(shard)
+
+        self.find_slowest_average()
+
+    def shard_options(self) -> dict:
+        """Параметры Parser для процессов-обработчиков parse_file и
+        parse_files, чтобы участки разбирались в режиме этого парсера.
+        Инкрементальный режим нужен только при объединении, поэтому
+        обработчикам не передаётся. Если статистику этого парсера нельзя
+        собрать из участков (приближённый режим, скользящие окна),
+        возбуждается ValueError."""
+        if self.approximate:
+            raise ValueError('approximate parsers cannot be merged')
+        if self.windows:
+            raise ValueError('rolling windows cannot be merged')
+        return {'percentiles': self.percentiles}
+
+    def parse_stream(self, file) -> None:
+        """Обрабатывает двоичный поток (например, распаковываемый файл).
+        Чтение и распаковка идут в отдельном потоке блоками по READ_BLOCK
+        байт, одновременно с разбором уже прочитанных блоков. Ошибка
+        чтения или распаковки возбуждается здесь; при ошибке разбора поток
+        чтения останавливается."""
+        blocks = queue.Queue(READ_QUEUE)
+        stopped = threading.Event()
+        reader = threading.Thread(target=read_blocks,
+                                  args=(file, blocks, stopped), daemon=True)
+        reader.start()
+
+        try:
+            rest = b''
+            while True:
+                block = blocks.get()
+                if block is None:
+                    break
+                if isinstance(block, Exception):
+                    raise block
+                block = rest + block
+                end = block.rfind(b'\n') + 1
+                rest = block[end:]
+                for line in block[:end].decode().split('\n')[:-1]:
+                    self.add_line(line)
+            if rest:
+                self.add_line(rest.decode())
+        finally:
+            stopped.set()
+            while reader.is_alive():
+                try:
+                    blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def add_line(self, line) -> None:
+        """Получив на вход строку лога, проверяет её на корректность и
+        добавляет в статистику."""
+        entry_info = self.extract_info(line)
+        if entry_info:
+            self.update_stats(entry_info)
+
+    def parse_columns(self, lines, columns: 'Columns' = None) -> 'Columns':
+        """Разбирает строки lines в столбцы (см. Columns), не меняя
+        статистику парсера. Страницы, браузеры и клиенты кодируются
+        отдельными от статистики таблицами, общими для всех вызовов этого
+        парсера, поэтому столбцы разных вызовов совместимы. Если передан
+        columns, строки дописываются в него."""
+        if columns is None:
+            if self.column_tables is None:
+                self.column_tables = (StringTable(), StringTable(),
+                                      AddressTable())
+            columns = Columns(*self.column_tables)
+        extract_info = self.extract_info
+        intern_address = columns.address_table.intern
+        packed = columns.address_table.addresses
+        irregular = columns.address_table.irregular
+        for line in lines:
+            info = extract_info(line)
+            if info is None:
+                continue
+            client = intern_address(info['ip'])
+            columns.clients.append(client)
+            columns.ips.append(packed[client])
+            columns.ip_mask.append(client not in irregular)
+            columns.days.append(self.day_ordinal(info['date']))
+            clock = info['clock']
+            columns.seconds.append(int(clock[:2]) * 3600 +
+                                   int(clock[3:5]) * 60 + int(clock[6:]))
+            columns.pages.append(columns.url_table.intern(info['url']))
+            columns.agents.append(
+                columns.agent_table.intern(info['browser']))
+            columns.add_time(info['time'])
+        return columns
+
+    def add_columns(self, columns: 'Columns') -> None:
+        """Добавляет в статистику строки из столбцов, в том числе
+        закодированных другими словарями (например, загруженных из кэша).
+        В обычном режиме статистика пополняется агрегатами по столбцам,
+        а в остальных режимах строки восстанавливаются и проходят через
+        update_stats."""
+        if self.incremental or self.percentiles or self.approximate or \
+                self.windows or self.metrics is not None:
+            for data in columns.records():
+                self.update_stats(data)
+            return
+
+        page_codes, times = columns.timed()
+        if times:
+            slowest = max(times)
+            if slowest >= self.slowest_page_time:
+                self.slowest_page_time = slowest
+                self.slowest_page = columns.url_table.name(page_codes[
+                    len(times) - 1 - times[::-1].index(slowest)])
+            fastest = min(times)
+            if fastest <= self.fastest_page_time:
+                self.fastest_page_time = fastest
+                self.fastest_page = columns.url_table.name(page_codes[
+                    len(times) - 1 - times[::-1].index(fastest)])
+
+        hits = Counter(columns.pages)
+        totals = Counter()
+        for page, time in zip(page_codes, times):
+            totals[page] += time
+        for page, url in enumerate(columns.url_table.names):
+            if hits[page]:
+                self.add_page(url, hits[page], totals[page])
+
+        for agent, count in Counter(columns.agents).items():
+            self.most_popular_agents.add(
+                self.agents.intern(columns.agent_table.name(agent)), count)
+        clients = {}
+        for client, count in Counter(columns.clients).items():
+            clients[client] = self.addresses.intern(
+                columns.address_table.name(client))
+            self.most_active_clients.add(clients[client], count)
+        for (day, client), count in Counter(zip(columns.days,
+                                                columns.clients)).items():
+            if day not in self.days:
+                self.days[day] = self.new_day_top()
+            self.days[day].add(clients[client], count)
+
+    def add_cached_file(self, filename: str, cache: str = None) -> 'Columns':
+        """Добавляет в статистику строки файла с логами через двоичный кэш
+        разобранных строк (по умолчанию filename + CACHE_SUFFIX). Если кэш
+        записан для файла того же размера и времени изменения, регулярное
+        выражение не применяется вовсе; иначе файл разбирается, и кэш
+        перезаписывается. Возвращает столбцы файла."""
+        if cache is None:
+            cache = filename + CACHE_SUFFIX
+        columns = Columns.load(cache, filename)
+        if columns is None:
+            source = os.stat(filename)
+            with open(filename) as f:
+                columns = Parser().parse_columns(f)
+            if isinstance(columns.times, array):
+                columns.save(cache, source)
+        self.add_columns(columns)
+        return columns
+
+    def column_batches(self, lines, size: int) -> iter:
+        """Генератор: разбирает строки lines пачками по size строк и
+        выдаёт столбцы каждой пачки."""
+        lines = iter(lines)
+        while True:
+            batch = list(islice(lines, size))
+            if not batch:
+                return
+            yield self.parse_columns(batch)
+
+    def add_file(self, filename: str) -> None:
+        """Добавляет в статистику все строки файла с логами. Файл
+        отображается в память и разбирается без декодирования строк."""
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    self.add_buffer(buf, 0, len(buf))
+
+    def extract_info(self, s: str) -> (None, dict):
+        """Проверяет корректность строки и извлекает из неё информацию.
+        Возвращает None в случае некорректной информации. Строки без
+        обязательного фрагмента ' - - [' отбрасываются без регулярного
+        выражения."""
+        if ' - - [' not in s:
+            return None
+        data = self.pattern.match(s)
+        return data.groupdict() if data else None
+
+    def add_buffer(self, buffer, start: int, end: int) -> None:
+        """Обрабатывает строки байтового буфера (например, отображённого в
+        память файла), начинающиеся в промежутке [start, end). Регулярное
+        выражение применяется прямо к буферу, без копирования строк. Цифры
+        и непробельные символы в байтовом выражении — только ASCII, поэтому
+        строки с другими байтами декодируются и разбираются extract_info,
+        как в add_line."""
+        match = self.byte_pattern.match
+        search_wide = NON_ASCII.search
+        wide = -1
+        position = start
+        while position < end:
+            line_end = buffer.find(b'\n', position)
+            if line_end == -1:
+                line_end = len(buffer)
+            if wide < position:
+                found = search_wide(buffer, position)
+                wide = found.start() if found else len(buffer)
+            if wide < line_end:
+                info = self.extract_info(buffer[position:line_end].decode())
+                if info:
+                    self.update_stats(info)
+            else:
+                data = match(buffer, position, line_end)
+                if data:
+                    self.update_stats(self.decode_info(data))
+            position = line_end + 1
+
+    def decode_info(self, data) -> dict:
+        """Преобразует результат байтового регулярного выражения в словарь,
+        как у extract_info. Декодируются только адрес страницы и браузер:
+        IP состоит из ASCII-символов, даты берутся из кэша, а время остаётся
+        байтовой строкой, которую понимает int()."""
+        ip, date, clock, url, browser, time = data.group(
+            'ip', 'date', 'clock', 'url', 'browser', 'time')
+        date_name = self.date_names.get(date)
+        if date_name is None:
+            date_name = self.date_names[date] = date.decode('ascii')
+
+        return {'ip': ip.decode('latin-1'), 'date': date_name,
+                'clock': clock.decode('ascii'), 'url': url.decode(),
+                'browser': browser.decode(), 'time': time}
+
+    def day_ordinal(self, day: str) -> int:
+        """Переводит дату вида 17/Feb/2013 в порядковый номер дня
+        (date.toordinal) без strptime. Различных дат в логе немного, поэтому
+        результаты кэшируются; размер кэша ограничен DAY_CACHE_SIZE."""
+        ordinal = self.day_ordinals.get(day)
+        if ordinal is None:
+            if len(self.day_ordinals) >= DAY_CACHE_SIZE:
+                self.day_ordinals.clear()
+            ordinal = self.day_ordinals[day] = date(
+                int(day[7:]), MONTHS[day[3:6]], int(day[:2])).toordinal()
+        return ordinal
+
+    def update_stats(self, data: dict) -> None:
+        """Обновляет данные в соответствии с новой информацией."""
+        if data['time']:
+            page_time = int(data['time'])
+
+            if page_time >= self.slowest_page_time:
+                self.slowest_page_time = page_time
+                self.slowest_page = data['url']
+
+            if page_time <= self.fastest_page_time:
+                self.fastest_page_time = page_time
+                self.fastest_page = data['url']
+        else:
+            page_time = 0
+
+        if self.approximate:
+            self.update_approximate(data, page_time)
+            return
+
+        page = self.add_page(data['url'], 1, page_time)
+
+        if self.percentiles and data['time']:
+            sketch = self.latencies.get(page)
+            if sketch is None:
+                sketch = self.latencies[page] = LatencySketch()
+            sketch.add(page_time)
+
+        self.most_popular_agents.add(self.agents.intern(data['browser']))
+
+        client = self.addresses.intern(data['ip'])
+        self.most_active_clients.add(client)
+
+        day = self.day_ordinal(data['date'])
+        if day not in self.days:
+            self.days[day] = self.new_day_top()
+        self.days[day].add(client)
+
+        if self.incremental:
+            self.changed_pages.add(page)
+            self.changed_days.add(day)
+
+        if self.windows:
+            clock = data['clock']
+            timestamp = (day * 86400 + int(clock[:2]) * 3600 +
+                         int(clock[3:5]) * 60 + int(clock[6:]))
+            for window in self.windows:
+                window.add(timestamp, page, client, page_time)
+
+    def update_approximate(self, data: dict, page_time: int) -> None:
+        """update_stats приближённого режима: страницы, браузеры и клиенты
+        не интернируются, а учитываются в скетчах фиксированного размера."""
+        url = data['url']
+        self.most_popular_pages.add(url)
+        if page_time:
+            self.page_time_sketch.add(url, page_time)
+        self.most_popular_agents.add(data['browser'])
+
+        client = data['ip']
+        self.most_active_clients.add(client)
+
+        day = self.day_ordinal(data['date'])
+        if day not in self.days:
+            self.days[day] = self.new_day_top()
+            self.day_clients[day] = HyperLogLog(self.precision)
+        self.days[day].add(client)
+        self.day_clients[day].add(client)
+
+    def add_window(self, window: int, bucket: int) -> 'RollingWindow':
+        """Добавляет скользящее окно длиной window секунд с корзинами по
+        bucket секунд (см. RollingWindow) и возвращает его. В окно попадают
+        только строки, добавленные после его создания."""
+        if self.approximate:
+            raise ValueError('windows are not supported in approximate mode')
+        rolling = RollingWindow(window, bucket, self.urls.name,
+                                self.addresses.name)
+        self.windows.append(rolling)
+        return rolling
+
+    def add_page(self, url: str, hits: int, total_time: int) -> int:
+        """Учитывает hits загрузок страницы url с суммарным временем
+        total_time и возвращает номер страницы. Время хранится в массиве
+        64-битных чисел; если сумма в него не помещается, массив заменяется
+        списком."""
+        page = self.urls.intern(url)
+        if page == len(self.page_times):
+            self.page_times.append(0)
+        try:
+            self.page_times[page] += total_time
+        except OverflowError:
+            self.page_times = list(self.page_times)
+            self.page_times[page] += total_time
+        self.most_popular_pages.add(page, hits)
+        return page
+
+    def find_slowest_average(self) -> None:
+        """Подсчитывает среднее время загрузки для каждой страницы и находит
+        страницу с самым наихудшим временем. Средние считаются одним проходом
+        map по массивам суммарного времени и числа загрузок, наибольшее
+        находится max и index; при равенстве выигрывает страница,
+        встретившаяся раньше. В приближённом режиме вызывает
+        find_approximate_slowest_average."""
+        if self.approximate:
+            self.find_approximate_slowest_average()
+            return
+        averages = array('d', map(truediv, self.page_times,
+                                  self.most_popular_pages.results))
+        slowest_average_page_time = max(averages, default=0)
+
+        self.slowest_average_page = \
+            self.urls.name(averages.index(slowest_average_page_time)) \
+            if slowest_average_page_time > 0 else ''
+
+    def merge(self, other: 'Parser') -> None:
+        """Добавляет к статистике результаты другого парсера, обработавшего
+        следующий участок того же файла. Результат совпадает с последовательной
+        обработкой обоих участков. Скользящие окна не объединяются, а
+        приближённые парсеры объединять нельзя."""
+        if self.approximate or other.approximate:
+            raise ValueError('approximate parsers cannot be merged')
+        if other.fastest_page_time != math.inf:
+            if other.slowest_page_time >= self.slowest_page_time:
+                self.slowest_page_time = other.slowest_page_time
+                self.slowest_page = other.slowest_page
+
+            if other.fastest_page_time <= self.fastest_page_time:
+                self.fastest_page_time = other.fastest_page_time
+                self.fastest_page = other.fastest_page
+
+        for url, hits, total_time in zip(other.urls.names,
+                                         other.most_popular_pages.results,
+                                         other.page_times):
+            page = self.add_page(url, hits, total_time)
+            if self.incremental:
+                self.changed_pages.add(page)
+        if self.percentiles:
+            for page, sketch in other.latencies.items():
+                page = self.urls.intern(other.urls.name(page))
+                self.latencies.setdefault(page, LatencySketch()).merge(sketch)
+
+        for browser, hits in zip(other.agents.names,
+                                 other.most_popular_agents.results):
+            self.most_popular_agents.add(self.agents.intern(browser), hits)
+
+        clients = [self.addresses.intern(other.addresses.name(client))
+                   for client in range(len(other.addresses))]
+        for client, hits in other.most_active_clients.items():
+            self.most_active_clients.add(clients[client], hits)
+
+        for day, top in other.days.items():
+            if day not in self.days:
+                self.days[day] = self.new_day_top()
+            for client, hits in top.items():
+                self.days[day].add(clients[client], hits)
+            if self.incremental:
+                self.changed_days.add(day)
+
+    def save_checkpoint(self, filename: str, offset: int,
+                        source: tuple = None) -> None:
+        """Сохраняет состояние парсера вместе со смещением offset во входном
+        файле и его описанием source (см. file_identity). Файл заменяется
+        атомарно, поэтому прерванная запись не портит предыдущую
+        контрольную точку."""
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump((CHECKPOINT_VERSION, source, offset, self), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def load_checkpoint(filename: str, source: tuple = None) -> tuple:
+        """Загружает контрольную точку, записанную save_checkpoint.
+        Возвращает пару (парсер, смещение во входном файле). Если передан
+        source, а точка записана для другого входного файла, возбуждается
+        ValueError."""
+        with open(filename, 'rb') as f:
+            version, saved_source, offset, parser = pickle.load(f)
+        if version != CHECKPOINT_VERSION:
+            raise ValueError('unsupported checkpoint version: ' + str(version))
+        if source is not None and saved_source != source:
+            raise ValueError('checkpoint was saved for another input file')
+        return parser, offset
+
+    def update_slowest_average(self) -> None:
+        """Инкрементальная версия find_slowest_average. Средние времена
+        изменившихся страниц добавляются в кучу, устаревшие записи
+        отбрасываются при достижении вершины кучи. При равенстве средних
+        выигрывает страница, встретившаяся раньше, как и при полном
+        просмотре."""
+        hits = self.most_popular_pages.results
+        for page in self.changed_pages:
+            heapq.heappush(self.averages,
+                           (-self.page_times[page] / hits[page], page))
+        self.changed_pages.clear()
+
+        if len(self.averages) > 2 * len(self.page_times) + 64:
+            self.averages = [(-total_time / hits[page], page)
+                             for page, total_time
+                             in enumerate(self.page_times)]
+            heapq.heapify(self.averages)
+
+        while self.averages:
+            average, page = self.averages[0]
+            if -average == self.page_times[page] / hits[page]:
+                break
+            heapq.heappop(self.averages)
+
+        self.slowest_average_page = \
+            self.urls.name(self.averages[0][1]) \
+            if self.averages and self.averages[0][0] < 0 else ''
+
+    def update_day_results(self) -> None:
+        """Обновляет лучших клиентов для дней, в которые были новые
+        обращения."""
+        for day in self.changed_days:
+            self.day_results[date.fromordinal(day)] = self.days[day].get_top()
+        self.changed_days.clear()
+
+    def find_approximate_slowest_average(self) -> None:
+        """Находит самую медленную в среднем страницу среди кандидатов в
+        самые популярные по оценкам суммарного времени и числа загрузок."""
+        slowest = (0, '')
+        for url, hits in self.most_popular_pages.candidates.items():
+            average = self.page_time_sketch.estimate(url) / hits
+            slowest = max(slowest, (average, url))
+        self.slowest_average_page = slowest[1]
+
+    def results(self) -> dict:
+        """Возвращает словарь из результатов подсчитанной статистики. В
+        приближённом режиме в него добавляется оценка числа различных
+        клиентов по дням DistinctClientsByDay."""
+        if self.approximate:
+            self.find_approximate_slowest_average()
+            by_day = {date.fromordinal(day): self.days[day].get_top()
+                      for day in sorted(self.days.keys())}
+        elif self.incremental:
+            self.update_slowest_average()
+            self.update_day_results()
+            by_day = dict(self.day_results)
+        else:
+            self.find_slowest_average()
+            by_day = {date.fromordinal(day): self.days[day].get_top()
+                      for day in sorted(self.days.keys())}
+
+        results = {'FastestPage': self.fastest_page,
+                   'MostActiveClient': self.most_active_clients.get_top(),
+                   'MostActiveClientByDay': by_day,
+                   'MostPopularBrowser': self.most_popular_agents.get_top(),
+                   'MostPopularPage': self.most_popular_pages.get_top(),
+                   'SlowestAveragePage': self.slowest_average_page,
+                   'SlowestPage': self.slowest_page}
+        if self.percentiles:
+            results.update(self.latency_results())
+        if self.approximate:
+            results['DistinctClientsByDay'] = {
+                date.fromordinal(day): self.day_clients[day].estimate()
+                for day in sorted(self.day_clients.keys())}
+        return results
+
+    def page_percentiles(self, url: str) -> dict:
+        """Возвращает перцентили PERCENTILES времени загрузки страницы url
+        или пустой словарь, если время её загрузки неизвестно."""
+        page = self.urls.ids.get(url)
+        sketch = self.latencies.get(page)
+        return sketch.percentiles() if sketch is not None else {}
+
+    def latency_results(self) -> dict:
+        """Перцентили времени загрузки по всем страницам и страница с
+        наибольшим 99-м перцентилем (при равенстве — с лексикографически
+        большим адресом)."""
+        total = LatencySketch()
+        slowest = (0, '')
+        for page, sketch in self.latencies.items():
+            total.merge(sketch)
+            slowest = max(slowest, (sketch.quantile(0.99),
+                                    self.urls.name(page)))
+        return {'LatencyPercentiles': total.percentiles(),
+                'SlowestP99Page': slowest[1]}
+
+    def snapshots(self, interval: float, lines) -> iter:
+        """Генератор: добавляет в статистику строки из lines и не чаще, чем
+        раз в interval секунд, выдаёт результаты в формате results().
+        Пустые строки (их выдаёт follow, пока в файле нет новых данных)
+        только проверяют таймер. По окончании строк выдаются итоговые
+        результаты."""
+        last = time.monotonic()
+        for line in lines:
+            if line:
+                self.add_line(line)
+            now = time.monotonic()
+            if now - last >= interval:
+                last = now
+                yield self.results()
+        yield self.results()
+
+    def report(self, sink):
+        """Передаёт результаты results() приёмнику sink (см. TextSink,
+        DictSink, JsonSink) и возвращает его."""
+        sink.emit(self.results())
+        return sink
+
+    def print_stats(self, file=None) -> None:
+        """Выводит статистику в нужном формате на консоль или в файл
+        file."""
+        self.report(TextSink(file))
+
+
+class Metrics(object):
+    """
+    Метрики работы парсера: счётчики событий, таймеры вызовов (число и
+    суммарное время в наносекундах) и показатели, вычисляемые функциями при
+    экспорте. Экспортируются словарём (as_dict) или в текстовом формате
+    Prometheus (prometheus).
+    """
+    def __init__(self) -> None:
+        """Инициализация."""
+        self.counters = {}
+        self.timers = {}
+        self.gauges = []
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """Увеличивает счётчик name на amount."""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timed(self, name: str, function):
+        """Возвращает обёртку над function, которая считает её вызовы и
+        время в таймере name."""
+        timer = self.timers.setdefault(name, [0, 0])
+        clock = time.perf_counter_ns
+
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer[0] += 1
+                timer[1] += clock() - start
+        return wrapper
+
+    def gauge(self, name: str, labels: dict, function) -> None:
+        """Добавляет показатель name с метками labels, значение которого
+        при экспорте возвращает function."""
+        self.gauges.append((name, labels, function))
+
+    def as_dict(self) -> dict:
+        """Возвращает метрики словарём."""
+        gauges = {}
+        for name, labels, function in self.gauges:
+            key = ','.join('{}={}'.format(*label)
+                           for label in sorted(labels.items()))
+            gauges.setdefault(name, {})[key] = function()
+        return {'counters': dict(self.counters),
+                'timers': {name: {'calls': calls, 'seconds': total / 1e9}
+                           for name, (calls, total) in self.timers.items()},
+                'gauges': gauges}
+
+    def prometheus(self, prefix: str = 'log_parser') -> str:
+        """Возвращает метрики в текстовом формате Prometheus."""
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        for suffix in ('calls', 'seconds'):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, suffix))
+            for name, (calls, total) in sorted(self.timers.items()):
+                lines.append('{}_{}_total{{stage="{}"}} {}'.format(
+                    prefix, suffix, name,
+                    calls if suffix == 'calls' else total / 1e9))
+        declared = set()
+        for name, labels, function in self.gauges:
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+            lines.append('{}_{}{{{}}} {}'.format(
+                prefix, name, ','.join('{}="{}"'.format(*label)
+                                       for label in sorted(labels.items())),
+                function()))
+        return '\n'.join(lines) + '\n'
+
+
+class Columns(object):
+    """
+    Разобранные строки лога по столбцам, как в Arrow: упакованные
+    IPv4-адреса с маской корректных адресов, номера клиентов, порядковые
+    номера дней, секунды от начала дня, номера страниц и браузеров и время
+    загрузки с маской наличия. Номера страниц, браузеров и клиентов — коды
+    словарей url_table, agent_table и address_table. Редукторы считают по
+    столбцам те же поля, что Parser.results(), не обращаясь к строкам.
+    """
+    def __init__(self, url_table: 'StringTable', agent_table: 'StringTable',
+                 address_table: 'AddressTable') -> None:
+        """Инициализация."""
+        self.url_table = url_table
+        self.agent_table = agent_table
+        self.address_table = address_table
+        self.ips = array('I')
+        self.ip_mask = bytearray()
+        self.clients = array('I')
+        self.days = array('I')
+        self.seconds = array('I')
+        self.pages = array('I')
+        self.agents = array('I')
+        self.times = array('Q')
+        self.time_mask = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def add_time(self, time) -> None:
+        """Дописывает время загрузки или отсутствующее значение, если time
+        пусто. Если время не помещается в 64 бита, массив заменяется
+        списком."""
+        try:
+            self.times.append(int(time) if time else 0)
+        except OverflowError:
+            self.times = list(self.times)
+            self.times.append(int(time))
+        self.time_mask.append(1 if time else 0)
+
+    def extend(self, other: 'Columns') -> None:
+        """Дописывает столбцы other, закодированные теми же словарями."""
+        if (other.url_table, other.agent_table, other.address_table) != \
+                (self.url_table, self.agent_table, self.address_table):
+            raise ValueError('columns use different dictionaries')
+        for name in ('ips', 'ip_mask', 'clients', 'days', 'seconds', 'pages',
+                     'agents', 'time_mask'):
+            getattr(self, name).extend(getattr(other, name))
+        try:
+            self.times.extend(other.times)
+        except (OverflowError, TypeError):
+            self.times = list(self.times) + list(other.times)
+
+    @staticmethod
+    def top(counts: Counter, names) -> str:
+        """Возвращает имя кода с наибольшим числом, при равенстве —
+        лексикографически большее, или пустую строку."""
+        return max(((count, names(code)) for code, count in counts.items()),
+                   default=(0, ''))[1]
+
+    def timed(self) -> tuple:
+        """Возвращает страницы и времена строк, в которых есть время."""
+        return (list(compress(self.pages, self.time_mask)),
+                list(compress(self.times, self.time_mask)))
+
+    def slowest_page(self) -> str:
+        """Страница самой долгой загрузки; при равенстве — последняя."""
+        pages, times = self.timed()
+        if not times:
+            return ''
+        last = times[::-1].index(max(times))
+        return self.url_table.name(pages[len(pages) - 1 - last])
+
+    def fastest_page(self) -> str:
+        """Страница самой быстрой загрузки; при равенстве — последняя."""
+        pages, times = self.timed()
+        if not times:
+            return ''
+        last = times[::-1].index(min(times))
+        return self.url_table.name(pages[len(pages) - 1 - last])
+
+    def slowest_average_page(self) -> str:
+        """Страница с наибольшим средним временем загрузки (строки без
+        времени считаются нулём); при равенстве — встретившаяся раньше."""
+        hits = Counter(self.pages)
+        totals = Counter()
+        for page, time in zip(*self.timed()):
+            totals[page] += time
+        slowest, slowest_page = 0, None
+        for page in sorted(totals):
+            average = totals[page] / hits[page]
+            if average > slowest:
+                slowest, slowest_page = average, page
+        return self.url_table.name(slowest_page) \
+            if slowest_page is not None else ''
+
+    def most_active_client_by_day(self) -> dict:
+        """Самый активный клиент каждого дня."""
+        by_day = {}
+        for (day, client), count in Counter(zip(self.days,
+                                                self.clients)).items():
+            best = (count, self.address_table.name(client))
+            if best > by_day.get(day, (0, '')):
+                by_day[day] = best
+        return {date.fromordinal(day): by_day[day][1]
+                for day in sorted(by_day)}
+
+    def records(self) -> iter:
+        """Генератор: восстанавливает словари в формате extract_info по
+        строкам столбцов."""
+        months = list(MONTHS)
+        dates = {}
+        for client, day, seconds, page, agent, time, timed in zip(
+                self.clients, self.days, self.seconds, self.pages,
+                self.agents, self.times, self.time_mask):
+            if day not in dates:
+                moment = date.fromordinal(day)
+                dates[day] = '{:02}/{}/{}'.format(
+                    moment.day, months[moment.month - 1], moment.year)
+            yield {'ip': self.address_table.name(client), 'date': dates[day],
+                   'clock': '{:02}:{:02}:{:02}'.format(
+                       seconds // 3600, seconds // 60 % 60, seconds % 60),
+                   'url': self.url_table.name(page),
+                   'browser': self.agent_table.name(agent),
+                   'time': str(time) if timed else None}
+
+    def save(self, filename: str, source: os.stat_result) -> None:
+        """Записывает столбцы и словари в двоичный файл кэша для исходного
+        файла с параметрами source (размер и время изменения). Разделы
+        выровнены по 8 байт, чтобы load мог отобразить их в память без
+        копирования. Файл заменяется атомарно."""
+        irregular = self.address_table.irregular
+        sections = [
+            '\n'.join(self.url_table.names).encode(),
+            '\n'.join(self.agent_table.names).encode(),
+            self.address_table.addresses.tobytes(),
+            '\n'.join('{} {}'.format(entry, ip)
+                      for entry, ip in irregular.items()).encode(),
+            self.ips.tobytes(), bytes(self.ip_mask), self.clients.tobytes(),
+            self.days.tobytes(), self.seconds.tobytes(),
+            self.pages.tobytes(), self.agents.tobytes(),
+            self.times.tobytes(), bytes(self.time_mask)]
+        table = []
+        offset = CACHE_HEADER.size + 16 * len(sections)
+        for section in sections:
+            offset += -offset % 8
+            table += [offset, len(section)]
+            offset += len(section)
+
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION,
+                                      source.st_size, source.st_mtime_ns,
+                                      len(self)))
+            f.write(struct.pack('<{}Q'.format(len(table)), *table))
+            for section in sections:
+                f.write(bytes(-f.tell() % 8))
+                f.write(section)
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def load(filename: str, source: str) -> (None, 'Columns'):
+        """Загружает столбцы из файла кэша, записанного save для файла
+        source. Возвращает None, если кэша нет, он записан для другой
+        версии файла или повреждён: разделы не помещаются в файл, их длины
+        не соответствуют числу строк или словари не читаются. Столбцы
+        отображаются в память и доступны только для чтения."""
+        try:
+            stat = os.stat(source)
+            f = open(filename, 'rb')
+        except OSError:
+            return None
+        with f:
+            header = f.read(CACHE_HEADER.size)
+            if len(header) < CACHE_HEADER.size:
+                return None
+            magic, version, size, mtime, rows = CACHE_HEADER.unpack(header)
+            if (magic, version, size, mtime) != (
+                    CACHE_MAGIC, CACHE_VERSION, stat.st_size,
+                    stat.st_mtime_ns):
+                return None
+            buffer = memoryview(mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_READ))
+
+        table_end = CACHE_HEADER.size + 16 * len(CACHE_SECTIONS)
+        if len(buffer) < table_end:
+            return None
+        table = struct.unpack_from('<{}Q'.format(2 * len(CACHE_SECTIONS)),
+                                   buffer, CACHE_HEADER.size)
+        code, wide = struct.calcsize('I'), struct.calcsize('Q')
+        lengths = {'ips': code * rows, 'ip_mask': rows,
+                   'clients': code * rows, 'days': code * rows,
+                   'seconds': code * rows, 'pages': code * rows,
+                   'agents': code * rows, 'times': wide * rows,
+                   'time_mask': rows}
+        views = {}
+        for name, offset, length in zip(CACHE_SECTIONS, table[::2],
+                                        table[1::2]):
+            if offset < table_end or offset + length > len(buffer) or \
+                    length != lengths.get(name, length):
+                return None
+            views[name] = buffer[offset:offset + length]
+        if len(views['addresses']) % code:
+            return None
+
+        def names(view) -> list:
+            return str(view, 'utf-8').split('\n') if len(view) else []
+
+        url_table = StringTable()
+        agent_table = StringTable()
+        address_table = AddressTable()
+        try:
+            for name in names(views['urls']):
+                url_table.intern(name)
+            for name in names(views['agent_names']):
+                agent_table.intern(name)
+            for item in names(views['irregular']):
+                entry, ip = item.split(' ')
+                address_table.irregular[int(entry)] = ip
+        except ValueError:
+            return None
+        address_table.addresses.frombytes(views['addresses'])
+        address_table.ids = {
+            address_table.irregular.get(entry, address): entry
+            for entry, address in enumerate(address_table.addresses)}
+
+        columns = Columns(url_table, agent_table, address_table)
+        for name in ('ip_mask', 'time_mask'):
+            setattr(columns, name, views[name])
+        for name in ('ips', 'clients', 'days', 'seconds', 'pages', 'agents'):
+            setattr(columns, name, views[name].cast('I'))
+        columns.times = views['times'].cast('Q')
+        return columns
+
+    def results(self) -> dict:
+        """Возвращает словарь в формате Parser.results()."""
+        return {'FastestPage': self.fastest_page(),
+                'MostActiveClient': self.top(Counter(self.clients),
+                                             self.address_table.name),
+                'MostActiveClientByDay': self.most_active_client_by_day(),
+                'MostPopularBrowser': self.top(Counter(self.agents),
+                                               self.agent_table.name),
+                'MostPopularPage': self.top(Counter(self.pages),
+                                            self.url_table.name),
+                'SlowestAveragePage': self.slowest_average_page(),
+                'SlowestPage': self.slowest_page()}
+
+
+class StringTable(object):
+    """
+    Таблица интернирования строк: каждой различной строке сопоставляется
+    плотный номер в порядке первого появления.
+    """
+    def __init__(self) -> None:
+        """Инициализация."""
+        self.ids = {}
+        self.names = []
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getstate__(self) -> list:
+        """При сериализации сохраняются только строки, словарь номеров
+        восстанавливается при загрузке."""
+        return self.names
+
+    def __setstate__(self, names: list) -> None:
+        self.names = names
+        self.ids = dict(zip(names, range(len(names))))
+
+    def intern(self, name: str) -> int:
+        """Возвращает номер строки, добавляя её в таблицу при первом
+        появлении."""
+        entry = self.ids.get(name)
+        if entry is None:
+            entry = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return entry
+
+    def name(self, entry: int) -> str:
+        """Возвращает строку по её номеру."""
+        return self.names[entry]
+
+
+class AddressTable(object):
+    """
+    Таблица IP-адресов с плотными номерами. Адреса в каноническом виде
+    хранятся упакованными в 32-битные числа и превращаются обратно в строку
+    только при выводе. Адреса, которые пропускает pattern, но которые не
+    являются корректными IPv4 (ведущие нули, октеты больше 255), хранятся
+    строками, чтобы не совпасть с каноническими.
+    """
+    def __init__(self) -> None:
+        """Инициализация."""
+        self.ids = {}
+        self.addresses = array('I')
+        self.irregular = {}
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def __getstate__(self) -> tuple:
+        """При сериализации сохраняются только адреса, словарь номеров
+        восстанавливается при загрузке."""
+        return self.addresses, self.irregular
+
+    def __setstate__(self, state: tuple) -> None:
+        self.addresses, self.irregular = state
+        self.ids = {ip: entry for entry, ip in self.irregular.items()}
+        self.ids.update((address, entry)
+                        for entry, address in enumerate(self.addresses)
+                        if entry not in self.irregular)
+
+    def intern(self, ip: str) -> int:
+        """Возвращает номер адреса, добавляя его в таблицу при первом
+        появлении."""
+        try:
+            key = int.from_bytes(inet_pton(AF_INET, ip), 'big')
+        except OSError:
+            key = ip
+        entry = self.ids.get(key)
+        if entry is None:
+            entry = self.ids[key] = len(self.addresses)
+            if isinstance(key, str):
+                self.addresses.append(0)
+                self.irregular[entry] = ip
+            else:
+                self.addresses.append(key)
+        return entry
+
+    def name(self, entry: int) -> str:
+        """Возвращает адрес по его номеру."""
+        ip = self.irregular.get(entry)
+        if ip is None:
+            ip = inet_ntop(AF_INET, self.addresses[entry].to_bytes(4, 'big'))
+        return ip
+
+
+class LexicographicTop(object):
+    """
+    Счётчик с поддержкой лучшего элемента. Результаты элементов хранятся в
+    словаре, лучший элемент обновляется за O(1) при каждом изменении. При
+    равенстве результатов выше стоит элемент с лексикографически большим
+    именем. Элементами могут быть номера из таблицы строк, тогда их имена
+    возвращает функция names.
+    """
+    def __init__(self, names=None) -> None:
+        """Инициализация."""
+        self.names = names
+        self.results = {}
+        self.top_result = 0
+        self.top_entry = None
+        self.top_name = None
+
+    def name(self, entry) -> str:
+        """Возвращает имя элемента, по которому разрешается равенство."""
+        return entry if self.names is None else self.names(entry)
+
+    def get_result(self, entry) -> int:
+        """Возвращает текущий результат элемента."""
+        return self.results.get(entry, 0)
+
+    def items(self) -> iter:
+        """Возвращает пары (элемент, результат)."""
+        return self.results.items()
+
+    def add(self, entry, amount: int = 1) -> int:
+        """Увеличивает результат элемента на amount и возвращает новый
+        результат."""
+        result = self.results[entry] = self.results.get(entry, 0) + amount
+        self.update_top(entry, result, amount)
+        return result
+
+    def add_entry(self, entry, entry_result: int) -> None:
+        """Устанавливает новый результат элемента."""
+        self.add(entry, entry_result - self.get_result(entry))
+
+    def update_top(self, entry, result: int, amount: int) -> None:
+        """Обновляет лучший элемент после изменения результата entry. Если
+        результат лучшего элемента уменьшился, лучший ищется заново."""
+        if result > self.top_result:
+            self.top_result = result
+            self.top_entry = entry
+            self.top_name = self.name(entry)
+        elif result == self.top_result:
+            name = self.name(entry)
+            if self.top_entry is None or name > self.top_name:
+                self.top_entry = entry
+                self.top_name = name
+        elif amount < 0 and entry == self.top_entry:
+            self.top_result = 0
+            self.top_entry = self.top_name = None
+            for entry, result in self.items():
+                self.update_top(entry, result, 0)
+
+    def get_top_n(self, n: int) -> list:
+        """Возвращает имена не более n лучших элементов по убыванию
+        результата, при равенстве результатов — по убыванию имён."""
+        if self.top_entry is None or n <= 0:
+            return []
+        if n == 1:
+            return [self.top_name]
+
+        threshold = heapq.nlargest(n, (result for _, result
+                                       in self.items()))[-1]
+        candidates = [(result, self.name(entry))
+                      for entry, result in self.items()
+                      if result >= threshold]
+        return [name for _, name in heapq.nlargest(n, candidates)]
+
+    def get_top(self) -> str:
+        """Возвращает имя лучшего элемента или пустую строку, если топ
+        пуст."""
+        return self.top_name if self.top_entry is not None else ''
+
+
+class DenseTop(LexicographicTop):
+    """
+    LexicographicTop для элементов — плотных номеров 0, 1, 2, ... из таблицы
+    строк: результаты хранятся не в словаре, а в массиве.
+    """
+    def __init__(self, names=None) -> None:
+        """Инициализация."""
+        super().__init__(names)
+        self.results = array('Q')
+
+    def get_result(self, entry: int) -> int:
+        """Возвращает текущий результат элемента."""
+        return self.results[entry] if entry < len(self.results) else 0
+
+    def items(self) -> iter:
+        """Возвращает пары (элемент, результат)."""
+        return enumerate(self.results)
+
+    def add(self, entry: int, amount: int = 1) -> int:
+        """Увеличивает результат элемента на amount и возвращает новый
+        результат."""
+        results = self.results
+        while entry >= len(results):
+            results.append(0)
+        results[entry] += amount
+        result = results[entry]
+        self.update_top(entry, result, amount)
+        return result
+
+
+class LatencySketch(object):
+    """
+    Гистограмма времени загрузки с логарифмическими корзинами (как в
+    DDSketch): значение x попадает в корзину ceil(log(x) / log(gamma)), где
+    gamma = (1 + accuracy) / (1 - accuracy), поэтому любой перцентиль
+    вычисляется с относительной ошибкой не больше accuracy. Число корзин
+    растёт как логарифм отношения наибольшего значения к наименьшему (для
+    64-битных времён и точности 1% — не больше ~2200), а гистограммы с
+    одинаковой точностью складываются без потери точности.
+    """
+    def __init__(self, accuracy: float = 0.01) -> None:
+        """Инициализация."""
+        if not 0 < accuracy < 1:
+            raise ValueError('accuracy must be between 0 and 1')
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value: int, count: int = 1) -> None:
+        """Учитывает count значений value."""
+        if value > 0:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        else:
+            self.zeros += count
+        self.count += count
+
+    def merge(self, other: 'LatencySketch') -> None:
+        """Добавляет значения гистограммы other с той же точностью."""
+        if other.gamma != self.gamma:
+            raise ValueError('sketches have different accuracy')
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        """Возвращает q-квантиль (0 <= q <= 1) учтённых значений или 0, если
+        значений нет."""
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 0
+
+    def percentiles(self) -> dict:
+        """Возвращает словарь перцентилей PERCENTILES, округлённых до целых,
+        или пустой словарь, если значений нет."""
+        if not self.count:
+            return {}
+        return {percent: round(self.quantile(percent / 100))
+                for percent in PERCENTILES}
+
+
+class CountMinSketch(object):
+    """
+    Count-Min скетч: depth строк по width счётчиков. Элемент увеличивает по
+    одному счётчику в каждой строке, а оценка его результата — минимум из
+    этих счётчиков. Оценка не меньше точного значения и с вероятностью
+    confidence превышает его не больше, чем на error * (сумма всех
+    добавлений). Занимает 8 * width * depth байт, где
+    width = ceil(e / error), depth = ceil(ln(1 / (1 - confidence))).
+    """
+    def __init__(self, error: float = SKETCH_ERROR,
+                 confidence: float = SKETCH_CONFIDENCE) -> None:
+        """Инициализация."""
+        if not (0 < error < 1 and 0 < confidence < 1):
+            raise ValueError('error and confidence must be between 0 and 1')
+        self.width = math.ceil(math.e / error)
+        self.depth = math.ceil(math.log(1 / (1 - confidence)))
+        self.rows = [array('Q', bytes(8 * self.width))
+                     for _ in range(self.depth)]
+
+    def add(self, entry, amount: int = 1) -> int:
+        """Увеличивает результат элемента на amount и возвращает новую
+        оценку. Номера счётчиков получаются двойным хешированием из hash,
+        поэтому скетч нельзя переносить между процессами."""
+        key = hash(entry)
+        step = (key >> 32) | 1
+        estimate = None
+        for row in self.rows:
+            key = (key + step) % self.width
+            row[key] += amount
+            if estimate is None or row[key] < estimate:
+                estimate = row[key]
+        return estimate
+
+    def estimate(self, entry) -> int:
+        """Возвращает оценку результата элемента."""
+        key = hash(entry)
+        step = (key >> 32) | 1
+        estimate = None
+        for row in self.rows:
+            key = (key + step) % self.width
+            if estimate is None or row[key] < estimate:
+                estimate = row[key]
+        return estimate
+
+
+class CountMinTop(CountMinSketch):
+    """
+    CountMinSketch с поддержкой size кандидатов в лучшие элементы (тяжёлых
+    элементов) и их оценок. Элемент вытесняет из кандидатов самый слабый,
+    если его оценка больше. Если лучший элемент опережает остальных с
+    запасом больше ошибки скетча, get_top совпадает с LexicographicTop.
+    """
+    def __init__(self, error: float = SKETCH_ERROR,
+                 confidence: float = SKETCH_CONFIDENCE,
+                 size: int = HEAVY_HITTERS) -> None:
+        """Инициализация."""
+        super().__init__(error, confidence)
+        self.size = size
+        self.candidates = {}
+        self.floor = 0
+
+    def add(self, entry, amount: int = 1) -> int:
+        """Увеличивает результат элемента на amount и возвращает новую
+        оценку."""
+        estimate = super().add(entry, amount)
+        candidates = self.candidates
+        if entry in candidates or len(candidates) < self.size:
+            candidates[entry] = estimate
+        elif estimate > self.floor:
+            weakest = min(candidates, key=candidates.get)
+            self.floor = candidates[weakest]
+            if estimate > self.floor:
+                del candidates[weakest]
+                candidates[entry] = estimate
+        return estimate
+
+    def get_top_n(self, n: int) -> list:
+        """Возвращает не более n лучших кандидатов по убыванию оценки, при
+        равенстве — по убыванию имён."""
+        return [entry for _, entry in heapq.nlargest(
+            n, ((result, entry) for entry, result
+                in self.candidates.items()))]
+
+    def get_top(self) -> str:
+        """Возвращает лучший элемент или пустую строку, если кандидатов
+        нет."""
+        top = self.get_top_n(1)
+        return top[0] if top else ''
+
+
+class HyperLogLog(object):
+    """
+    Оценка числа различных элементов HyperLogLog: 2 ** precision
+    однобайтовых регистров, стандартная ошибка около
+    1.04 / sqrt(2 ** precision) (1.6% при precision = 12). Для малых
+    количеств используется линейный подсчёт.
+    """
+    def __init__(self, precision: int = HLL_PRECISION) -> None:
+        """Инициализация."""
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16')
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, entry) -> None:
+        """Учитывает элемент."""
+        key = hash(entry) & 0xFFFFFFFFFFFFFFFF
+        index = key >> (64 - self.precision)
+        rest = key & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        """Добавляет элементы другой оценки с той же точностью."""
+        if other.precision != self.precision:
+            raise ValueError('estimators have different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        """Возвращает оценку числа различных элементов."""
+        count = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / count)
+        raw = alpha * count * count / sum(2.0 ** -register
+                                          for register in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * count and zeros:
+            return round(count * math.log(count / zeros))
+        return round(raw)
+
+
+class RollingWindow(object):
+    """
+    Статистика за последние window секунд по времени из строк лога. Окно
+    разбито на кольцо из window / bucket корзин по bucket секунд: в каждой
+    корзине свои счётчики обращений к страницам, суммарного времени загрузки
+    и обращений клиентов, а суммы по всему окну поддерживаются при
+    добавлении строк. При сдвиге окна устаревшие корзины вычитаются из сумм
+    и очищаются, поэтому устаревание стоит O(корзин), а не O(строк).
+    """
+    def __init__(self, window: int, bucket: int, page_names=None,
+                 client_names=None) -> None:
+        """Инициализация. Длина окна должна быть кратна длине корзины."""
+        if bucket <= 0 or window <= 0 or window % bucket:
+            raise ValueError('window must be a positive multiple of bucket')
+        self.window = window
+        self.bucket = bucket
+        self.page_names = page_names
+        self.client_names = client_names
+        self.buckets = [({}, {}, {}) for _ in range(window // bucket)]
+        self.latest = None
+
+        self.page_hits = {}
+        self.page_times = {}
+        self.client_hits = {}
+
+    def add(self, timestamp: int, page, client, page_time: int) -> None:
+        """Учитывает обращение клиента client к странице page в момент
+        timestamp (в секундах). Строки старше окна пропускаются."""
+        number = timestamp // self.bucket
+        if self.latest is None or number > self.latest:
+            self.advance(timestamp)
+        elif number <= self.latest - len(self.buckets):
+            return
+
+        hits, times, clients = self.buckets[number % len(self.buckets)]
+        hits[page] = hits.get(page, 0) + 1
+        self.page_hits[page] = self.page_hits.get(page, 0) + 1
+        if page_time:
+            times[page] = times.get(page, 0) + page_time
+            self.page_times[page] = self.page_times.get(page, 0) + page_time
+        clients[client] = clients.get(client, 0) + 1
+        self.client_hits[client] = self.client_hits.get(client, 0) + 1
+
+    def advance(self, timestamp: int) -> None:
+        """Сдвигает окно так, чтобы оно заканчивалось в момент timestamp.
+        Позволяет устаревать данным, когда новых строк нет."""
+        number = timestamp // self.bucket
+        if self.latest is not None and number > self.latest:
+            first = max(self.latest + 1, number - len(self.buckets) + 1)
+            for expired in range(first, number + 1):
+                for totals, counts in zip((self.page_hits, self.page_times,
+                                           self.client_hits),
+                                          self.buckets[expired %
+                                                       len(self.buckets)]):
+                    for key, value in counts.items():
+                        left = totals[key] - value
+                        if left:
+                            totals[key] = left
+                        else:
+                            del totals[key]
+                    counts.clear()
+        if self.latest is None or number > self.latest:
+            self.latest = number
+
+    @staticmethod
+    def top(counts: dict, names, n: int) -> list:
+        """Возвращает не более n пар (имя, значение) по убыванию значения,
+        при равенстве — по убыванию имени, как LexicographicTop."""
+        named = ((value, key if names is None else names(key))
+                 for key, value in counts.items())
+        return [(name, value) for value, name in heapq.nlargest(n, named)]
+
+    def top_pages(self, n: int = 1) -> list:
+        """Самые посещаемые страницы окна."""
+        return self.top(self.page_hits, self.page_names, n)
+
+    def slowest_pages(self, n: int = 1) -> list:
+        """Страницы окна с наибольшим средним временем загрузки."""
+        averages = {page: self.page_times.get(page, 0) / hits
+                    for page, hits in self.page_hits.items()}
+        return self.top(averages, self.page_names, n)
+
+    def most_active_clients(self, n: int = 1) -> list:
+        """Клиенты окна с наибольшим числом обращений."""
+        return self.top(self.client_hits, self.client_names, n)
+
+    def results(self, n: int = 1) -> dict:
+        """Возвращает словарь из n лучших элементов окна по каждой
+        статистике."""
+        return {'MostActiveClients': self.most_active_clients(n),
+                'MostPopularPages': self.top_pages(n),
+                'SlowestAveragePages': self.slowest_pages(n)}
+
+
+class TextSink(object):
+    """
+    Приёмник, который выводит результаты в формате консольной утилиты на
+    консоль или в файл file. Поля сверх обычных (в режимах percentiles и
+    approximate) выводятся после SlowestPage.
+    """
+    FIELDS = ('FastestPage', 'MostActiveClient', 'MostActiveClientByDay',
+              'MostPopularBrowser', 'MostPopularPage', 'SlowestAveragePage',
+              'SlowestPage')
+
+    def __init__(self, file=None) -> None:
+        """Инициализация."""
+        self.file = file
+
+    def emit(self, results: dict) -> None:
+        """Выводит результаты."""
+        file = self.file
+        print('FastestPage: ' + results['FastestPage'], file=file)
+        print('MostActiveClient: ' + results['MostActiveClient'], file=file)
+        print('MostActiveClientByDay: ', file=file)
+        for day, client in sorted(results['MostActiveClientByDay'].items()):
+            print('  ' + str(day) + ': ' + client, file=file)
+        print(file=file)
+        print('MostPopularBrowser: ' + results['MostPopularBrowser'],
+              file=file)
+        print('MostPopularPage: ' + results['MostPopularPage'], file=file)
+        print('SlowestAveragePage: ' + results['SlowestAveragePage'],
+              file=file)
+        print('SlowestPage: ' + results['SlowestPage'], file=file)
+        for key, value in results.items():
+            if key not in self.FIELDS:
+                print(key + ': ' + str(value), file=file)
+        print(file=file)
+
+
+class DictSink(object):
+    """
+    Приёмник, который сохраняет последний словарь результатов в results.
+    """
+    def __init__(self) -> None:
+        """Инициализация."""
+        self.results = None
+
+    def emit(self, results: dict) -> None:
+        """Сохраняет результаты."""
+        self.results = results
+
+
+class JsonSink(object):
+    """
+    Приёмник, который записывает результаты одной строкой JSON на консоль
+    или в файл file. Даты становятся строками вида 2013-02-17.
+    """
+    def __init__(self, file=None) -> None:
+        """Инициализация."""
+        self.file = file
+
+    @staticmethod
+    def convert(value):
+        """Заменяет даты в ключах словарей строками."""
+        if isinstance(value, dict):
+            return {key.isoformat() if isinstance(key, date) else key:
+                    JsonSink.convert(item) for key, item in value.items()}
+        return value
+
+    def emit(self, results: dict) -> None:
+        """Записывает результаты."""
+        print(json.dumps(self.convert(results), ensure_ascii=False),
+              file=self.file)
+
+
+def open_log(filename: str):
+    """Открывает файл с логами на чтение в двоичном режиме. Файлы с
+    расширениями .gz, .bz2, .xz и .lzma распаковываются на лету."""
+    opener = OPENERS.get(os.path.splitext(filename)[1], open)
+    return opener(filename, 'rb')
+
+
+def is_compressed(filename: str) -> bool:
+    """Проверяет, будет ли файл распакован при открытии через open_log."""
+    return os.path.splitext(filename)[1] in OPENERS
+
+
+def read_blocks(file, blocks: queue.Queue,
+                stopped: threading.Event = None) -> None:
+    """Читает поток блоками по READ_BLOCK байт и кладёт их в очередь blocks,
+    пока не установлено stopped. Конец потока отмечается None, ошибка
+    чтения передаётся через очередь как исключение. Распаковщики zlib, bz2
+    и lzma отпускают GIL, поэтому распаковка идёт параллельно с разбором."""
+    try:
+        while stopped is None or not stopped.is_set():
+            block = file.read(READ_BLOCK)
+            if not block:
+                break
+            blocks.put(block)
+    except Exception as error:
+        blocks.put(error)
+        return
+    blocks.put(None)
+
+
+def parse_log(filename: str, options: dict = None) -> Parser:
+    """Обрабатывает файл с логами целиком, при необходимости распаковывая
+    его, парсером с параметрами options. Используется
+    процессами-обработчиками в Parser.parse_files."""
+    parser = Parser(**(options or {}))
+    with open_log(filename) as f:
+        parser.parse_stream(f)
+    return parser
+
+
+def split_file(filename: str, parts: int) -> list:
+    """Делит файл на не более чем parts участков, границы которых совпадают с
+    началами строк. Возвращает список пар (начало, конец) в байтах."""
+    size = os.path.getsize(filename)
+    bounds = [0]
+
+    with open(filename, 'rb') as f:
+        for i in range(1, parts):
+            f.seek(max(size * i // parts, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:])
+            if start < end]
+
+
+def parse_range(filename: str, start: int, end: int,
+                use_mmap: bool = False, options: dict = None) -> Parser:
+    """Обрабатывает строки файла, начинающиеся в промежутке [start, end),
+    парсером с параметрами options. Используется процессами-обработчиками
+    в Parser.parse_file."""
+    parser = Parser(**(options or {}))
+
+    with open(filename, 'rb') as f:
+        if use_mmap:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                parser.add_buffer(buf, start, end)
+            return parser
+
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            position += len(line)
+            parser.add_line(line.decode())
+
+    return parser
+
+
+def file_identity(filename: str) -> tuple:
+    """Описание входного файла для контрольной точки: устройство, inode,
+    размер, время изменения и хеш первого блока. Если оно изменилось,
+    файл заменён (например, при ротации) или переписан."""
+    stat = os.stat(filename)
+    with open(filename, 'rb') as f:
+        digest = hashlib.sha1(f.read(READ_BLOCK)).hexdigest()
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+            digest)
+
+
+def parse_with_checkpoints(filename: str, checkpoint: str,
+                           interval: float = 60.0) -> Parser:
+    """Последовательно обрабатывает файл с логами, не реже чем раз в interval
+    секунд сохраняя контрольную точку в файл checkpoint. Если контрольная
+    точка уже есть и записана для этого же файла (см. file_identity),
+    состояние загружается из неё и обработка продолжается с сохранённого
+    места; точка от другого файла отбрасывается, и обработка начинается
+    заново. После успешного завершения контрольная точка удаляется."""
+    source = file_identity(filename)
+    parser, offset = Parser(), 0
+    if os.path.exists(checkpoint):
+        try:
+            parser, offset = Parser.load_checkpoint(checkpoint, source)
+        except ValueError:
+            parser, offset = Parser(), 0
+
+    last_checkpoint = time.monotonic()
+    with open_log(filename) as f:
+        f.seek(offset)
+        for number, line in enumerate(f, 1):
+            offset += len(line)
+            parser.add_line(line.decode())
+            if number % CHECKPOINT_LINES == 0 and \
+                    time.monotonic() - last_checkpoint >= interval:
+                parser.save_checkpoint(checkpoint, offset, source)
+                last_checkpoint = time.monotonic()
+
+    parser.find_slowest_average()
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return parser
@@ -1,182 +1,228 @@
 #!/usr/bin/env python3
 
-from datetime import datetime, date
+from datetime import date, datetime
+from itertools import compress
+from socket import inet_ntop, socketpair, AF_INET
+import asyncio
+import bz2
+import gzip
+import importlib.util
+import io
+import json
+import lzma
 import math
-import re
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
+from logstat import (AddressTable, CACHE_SUFFIX, DictSink, HEAVY_HITTERS,
+                     HyperLogLog, JsonSink, LatencySketch, LexicographicTop,
+                     MONTHS, Parser, RollingWindow, TextSink)
+import loggen
+import logstat
 
-class Parser(object):
-    """
-    Класс парсера для обработки файла с логами.
-    """
-    def __init__(self) -> None:
-        """Инициализация класса."""
-        self.slowest_page = ''
-        self.slowest_page_time = 0
-
-        self.slowest_average_page = ''
-
-        self.fastest_page = ''
-        self.fastest_page_time = math.inf
-
-        self.pages = {}
-        self.browsers = {}
-        self.clients = {}
-        self.clients_by_days = {}
-        self.days = {}
-
-        self.most_popular_pages = LexicographicTop()
-        self.most_popular_agents = LexicographicTop()
-        self.most_active_clients = LexicographicTop()
-
-        self.pattern = re.compile('(?P<ip>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
-                                  ' - - \[(?P<date>\d{2}/(Jan|Feb|Mar|Apr|May|'
-                                  'Jun|Jul|Aug|Sep|Oct|Nov|Dec)/20\d{2}):[0-2]'
-                                  '[0-9]:[0-5]\d:[0-5]\d \+\d{4}] "(GET|PUT|'
-                                  'POST|HEAD|OPTIONS|DELETE) (?P<url>\S+) '
-                                  '\S+" \d+ \d+ "\S+" "(?P<browser>.+)"( '
-                                  '(?P<time>\d+)|)')
-
-    def add_line(self, line) -> None:
-        """Получив на вход строку лога, проверяет её на корректность и добавляет
-        в статистику."""
-        entry_info = self.extract_info(line)
-        if entry_info:
-            self.update_stats(entry_info)
-
-    def extract_info(self, s: str) -> (None, dict):
-        """Проверяет корректность строки и извлекает из неё информацию.
-        Возвращает None в случае некорректной информации."""
-        data = re.match(self.pattern, s)
-        return data.groupdict() if data else None
-
-    def update_stats(self, data: dict) -> None:
-        """Обновляет данные в соответствии с новой информацией."""
-        if data['time']:
-            page_time = int(data['time'])
-
-            if page_time >= self.slowest_page_time:
-                self.slowest_page_time = page_time
-                self.slowest_page = data['url']
-
-            if page_time <= self.fastest_page_time:
-                self.fastest_page_time = page_time
-                self.fastest_page = data['url']
-
-            if data['url'] not in self.pages:
-                self.pages[data['url']] = Page(page_time)
-            else:
-                self.pages[data['url']].add_time(page_time)
-        else:
-            if data['url'] not in self.pages:
-                self.pages[data['url']] = Page(0)
-            else:
-                self.pages[data['url']].add_time(0)
 
-        if data['browser'] not in self.browsers:
-            self.browsers[data['browser']] = 1
-        else:
-            self.browsers[data['browser']] += 1
+STREAM_LIMIT = 1 << 20
 
-        if data['ip'] not in self.clients:
-            self.clients[data['ip']] = 1
-        else:
-            self.clients[data['ip']] += 1
 
-        self.most_popular_pages.add_entry(data['url'],
-                                          self.pages[data['url']].hits)
-        self.most_popular_agents.add_entry(data['browser'],
-                                           self.browsers[data['browser']])
-        self.most_active_clients.add_entry(data['ip'],
-                                           self.clients[data['ip']])
+def follow(file, poll_interval: float = 0.5) -> iter:
+    """Бесконечный генератор строк, дописываемых в открытый файл (как
+    tail -f). Пока новых данных нет, выдаёт пустые строки с интервалом
+    poll_interval секунд. Недописанная последняя строка придерживается до
+    появления перевода строки."""
+    pending = ''
+    while True:
+        line = file.readline()
+        if not line:
+            time.sleep(poll_interval)
+            yield ''
+            continue
+        pending += line
+        if pending.endswith('\n'):
+            yield pending
+            pending = ''
 
-        date = data['date']
 
-        if data['ip'] not in self.clients_by_days:
-            self.clients_by_days[data['ip']] = {}
-        if date not in self.clients_by_days[data['ip']]:
-            self.clients_by_days[data['ip']][date] = 1
-        else:
-            self.clients_by_days[data['ip']][date] += 1
-
-        if date not in self.days:
-            self.days[date] = LexicographicTop()
-        self.days[date].add_entry(data['ip'],
-                                  self.clients_by_days[data['ip']][date])
-
-    def find_slowest_average(self) -> None:
-        """Подсчитывает среднее время загрузки для каждой страницы и находит
-        страницу с самым наихудшим временем."""
-        slowest_average_page = ''
-        slowest_average_page_time = 0
-
-        for page in self.pages.keys():
-            average_time = self.pages[page].total_time / self.pages[page].hits
-            if average_time > slowest_average_page_time:
-                slowest_average_page_time = average_time
-                slowest_average_page = page
-
-        self.slowest_average_page = slowest_average_page
-
-    def results(self) -> dict:
-        """Возвращает словарь из результатов подсчитанной статистики."""
-        self.find_slowest_average()
-
-        return {'FastestPage': self.fastest_page,
-                'MostActiveClient': self.most_active_clients.get_top(),
-                'MostActiveClientByDay':
-                    {datetime.strptime(day, '%d/%b/%Y').date():
-                     self.days[day].get_top()
-                     for day in sorted(self.days.keys())},
-                'MostPopularBrowser': self.most_popular_agents.get_top(),
-                'MostPopularPage': self.most_popular_pages.get_top(),
-                'SlowestAveragePage': self.slowest_average_page,
-                'SlowestPage': self.slowest_page}
-
-
-class Page(object):
+class AsyncCollector(object):
     """
-    Класс страницы. Используется для подсчета количества загрузок конкретной
-    страницы и суммарного времени, затраченного на её открытие.
+    Асинхронный приём строк лога из нескольких источников сразу: потоков
+    asyncio (unix-сокеты, каналы) и обычных файлов. Строки собираются в
+    пачки по batch_size и передаются парсеру через очередь не более чем из
+    max_batches пачек. Когда очередь заполнена, источники перестают читать
+    данные, и для сокетов включается обратное давление. Строки, которые
+    парсер отверг с ValueError (например, с несуществующей датой),
+    пропускаются и считаются в rejected; другие ошибки парсера
+    запоминаются и возбуждаются из join и close.
     """
-    def __init__(self, time: int) -> None:
-        """Инициализация. Изначально к сумме прибавляется первое время загрузки
-        создаваемой страницы."""
-        self.total_time = time
-        self.hits = 1
+    def __init__(self, parser: Parser = None, batch_size: int = 512,
+                 max_batches: int = 64) -> None:
+        """Инициализация. Если парсер не передан, создаётся парсер в
+        режиме incremental."""
+        self.parser = parser if parser is not None else \
+            Parser(incremental=True)
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(max_batches)
+        self.consumer = None
+        self.rejected = 0
+        self.error = None
 
-    def add_time(self, time: int) -> None:
-        """Прибавляет новое время загрузки к суммарному для страницы."""
-        self.total_time += time
-        self.hits += 1
+    def start(self) -> None:
+        """Запускает задачу, передающую пачки строк парсеру. Должен
+        вызываться внутри работающего цикла событий."""
+        if self.consumer is None:
+            self.consumer = asyncio.ensure_future(self.consume())
 
+    async def consume(self) -> None:
+        """Передаёт парсеру пачки строк из очереди. После каждой пачки
+        управление возвращается циклу событий. Очередь разбирается и после
+        ошибки, чтобы источники и join не зависали."""
+        while True:
+            batch = await self.queue.get()
+            try:
+                for line in batch:
+                    try:
+                        self.parser.add_line(line)
+                    except ValueError:
+                        self.rejected += 1
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+            finally:
+                self.queue.task_done()
+            await asyncio.sleep(0)
 
-class LexicographicTop(object):
-    """
-    Структура для поддержания топа в наборе элементов. При запросе самого
-    популярного объекта возвращает лексикографически наименьшую единицу.
-    """
-    def __init__(self) -> None:
-        """Инициализация."""
-        self.top_entries = []
-        self.top_result = 0
-
-    def add_entry(self, entry: str, entry_result: int) -> None:
-        """Добавляет новый элемент к топу. Если результат элемента лучше
-        имеющегося, список лучших элементов очищается, иначе элемент
-        добавляется в топ."""
-        if entry_result == self.top_result:
-            self.top_entries.append(entry)
-        elif entry_result > self.top_result:
-            self.top_result = entry_result
-            self.top_entries.clear()
-            self.top_entries.append(entry)
-
-    def get_top(self) -> str:
-        """Возвращает лучший наименьший лексикографичеки элемент."""
-        return sorted(self.top_entries, reverse=True)[0] \
-            if len(self.top_entries) > 0 else ''
+    async def add_stream(self, reader: asyncio.StreamReader) -> None:
+        """Читает строки из потока до его закрытия."""
+        self.start()
+        batch = []
+        async for line in reader:
+            batch.append(line.decode())
+            if len(batch) == self.batch_size:
+                await self.queue.put(batch)
+                batch = []
+        if batch:
+            await self.queue.put(batch)
+
+    async def add_unix_socket(self, path: str = None, sock=None) -> None:
+        """Читает строки из unix-сокета по пути path или из уже открытого
+        сокета sock."""
+        reader, writer = await asyncio.open_unix_connection(
+            path, sock=sock, limit=STREAM_LIMIT)
+        try:
+            await self.add_stream(reader)
+        finally:
+            writer.close()
+
+    async def add_file(self, filename: str) -> None:
+        """Читает строки файла. Чтение идёт в отдельном потоке блоками
+        примерно по STREAM_LIMIT байт, чтобы не блокировать цикл событий."""
+        self.start()
+        with open(filename) as f:
+            while True:
+                batch = await asyncio.to_thread(f.readlines, STREAM_LIMIT)
+                if not batch:
+                    break
+                for start in range(0, len(batch), self.batch_size):
+                    await self.queue.put(batch[start:start + self.batch_size])
+
+    async def join(self) -> None:
+        """Дожидается, пока парсер обработает все принятые строки.
+        Возбуждает первую ошибку парсера, если она была."""
+        await self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    async def results(self) -> dict:
+        """Возвращает текущие результаты парсера. Вычисляются между пачками,
+        поэтому не пересекаются с добавлением строк."""
+        return self.parser.results()
+
+    async def close(self) -> None:
+        """Обрабатывает оставшиеся строки и останавливает приём."""
+        try:
+            await self.join()
+        finally:
+            if self.consumer is not None:
+                self.consumer.cancel()
+                try:
+                    await self.consumer
+                except asyncio.CancelledError:
+                    pass
+                self.consumer = None
+
+
+TOKENIZER_CORPUS = [
+    '192.168.65.56 - - [17/Feb/2013:06:37:31 +0600] "GET /a HTTP/1.1" 200 '
+    '1046 "http://192.168.65.101/pause/index" "ABC" 27979',
+    '192.168.65.56 - - [17/Feb/2013:06:37:31 +0600] "GET /a HTTP/1.1" 200 '
+    '1046 "http://192.168.65.101/pause/index" "ABC"\n',
+    '1.2.3.4 - - [01/Dec/2099:29:59:59 +0000] "OPTIONS /"q" "H" 1 2 "a"b" '
+    '"Mozilla "x" 12" 34\r\n',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "DELETE /x HTTP/1.0" 1 2 "-" '
+    '"B" 12abc',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "PUT /x HTTP/1.0" 1 2 "-" '
+    '"B" x 12',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "HEAD /x HTTP/1.0" 1 2 "-" '
+    '"B"  12',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "POST /x HTTP/1.0" 1 2 "-" '
+    '"B" 12 "C" 7',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" 1 2 "-" ""',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" 1 2 "-" """',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" 1 2 "-" "',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" 1 2 "" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET  /x HTTP/1.0" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x  HTTP/1.0" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0"  1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x "" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" 1 2 "-"  "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x\tHTTP/1.0" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" 1 2 "-" "\tB"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" 1 2 "-" '
+    '"B\n" 1',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /ж HTTP/1.0" 1 2 "-" "Б" 1',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" 1 2 "-" "B" ٣',
+    '1.2.3.٤ - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x\xa0y H" 1 2 "-" "B"',
+    '1.2.3.1234 - - [01/Dec/2013:23:59:59 +0000] "GET /x H" 1 2 "-" "B"',
+    '1.2.3 - - [01/Dec/2013:23:59:59 +0000] "GET /x H" 1 2 "-" "B"',
+    '1.2.3.4  - - [01/Dec/2013:23:59:59 +0000] "GET /x H" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dez/2013:23:59:59 +0000] "GET /x H" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/1999:23:59:59 +0000] "GET /x H" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:33:59:59 +0000] "GET /x H" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:60:59 +0000] "GET /x H" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 -0000] "GET /x H" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +000] "GET /x H" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "get /x H" 1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x H" -1 2 "-" "B"',
+    '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x H" 1 2 - "B"',
+    'hi!',
+    '',
+]
+
+
+def mutate(line: str, rng: random.Random) -> str:
+    """Вносит в строку несколько случайных правок из набора символов,
+    значимых для формата лога."""
+    alphabet = ' "0123456789./:[]+-\tGETabcЖ٣\r\n'
+    for _ in range(rng.randint(1, 3)):
+        position = rng.randrange(len(line) + 1)
+        action = rng.randrange(3)
+        if action == 0:
+            line = line[:position] + line[position + 1:]
+        elif action == 1:
+            line = line[:position] + rng.choice(alphabet) + line[position:]
+        else:
+            line = line[:position] + rng.choice(alphabet) + \
+                line[position + 1:]
+    return line
 
 
 def make_stat():
@@ -311,6 +357,837 @@ class LogStatTests(unittest.TestCase):
                               'SlowestAveragePage': '/something',
                               'SlowestPage': '/login'})
 
+    def testTopTracker(self):
+        top = LexicographicTop()
+        for _ in range(3):
+            for entry, result in (('a', 1), ('b', 1), ('a', 2), ('c', 1),
+                                  ('b', 2)):
+                top.add_entry(entry, result)
+        self.assertEqual(top.get_top(), 'b')
+        self.assertListEqual(top.get_top_n(5), ['b', 'a', 'c'])
+        self.assertListEqual(top.get_top_n(2), ['b', 'a'])
+        self.assertEqual(len(top.results), 3)
+        top.add_entry('b', 1)
+        self.assertEqual(top.get_top(), 'a')
+        self.assertListEqual(LexicographicTop().get_top_n(3), [])
+
+    def testPrefilter(self):
+        parser = make_stat()
+        rng = random.Random(2013)
+        corpus = TOKENIZER_CORPUS + [mutate(line, rng)
+                                     for line in TOKENIZER_CORPUS[:8]
+                                     for _ in range(500)]
+        for line in corpus:
+            data = parser.pattern.match(line)
+            expected = data.groupdict() if data else None
+            self.assertEqual(parser.extract_info(line), expected, line)
+
+    def testDayOrdinal(self):
+        parser = make_stat()
+        for month in MONTHS:
+            for day in ('01', '09', '28'):
+                name = day + '/' + month + '/2013'
+                self.assertEqual(
+                    date.fromordinal(parser.day_ordinal(name)),
+                    datetime.strptime(name, '%d/%b/%Y').date())
+        self.assertEqual(parser.day_ordinal('29/Feb/2012'),
+                         date(2012, 2, 29).toordinal())
+        self.assertRaises(ValueError, parser.day_ordinal, '29/Feb/2013')
+
+    def testIncrementalResults(self):
+        lines = ['10.0.0.%d - - [%02d/Feb/2013:06:37:31 +0600] "GET /%s '
+                 'HTTP/1.1" 200 1046 "http://192.168.65.101/" "ABC"%s'
+                 % (ip, day, url, page_time)
+                 for ip, day, url, page_time in
+                 ((1, 17, 'a', ' 10'), (2, 17, 'b', ' 10'), (2, 18, 'a', ''),
+                  (3, 18, 'c', ' 30'), (3, 17, 'c', ' 0'), (1, 18, 'b', ' 0'),
+                  (4, 19, 'd', ' 15'), (4, 19, 'c', ' 0'), (2, 19, 'a', ' 99'),
+                  (1, 17, 'd', ' 0'), (2, 18, 'b', ' 50'))]
+        parser = make_stat()
+        incremental = Parser(incremental=True)
+        for line in lines:
+            parser.add_line(line)
+            incremental.add_line(line)
+            self.assertDictEqual(incremental.results(), parser.results())
+
+        snapshots = list(Parser(incremental=True).snapshots(0, lines))
+        self.assertEqual(len(snapshots), len(lines) + 1)
+        self.assertDictEqual(snapshots[-1], parser.results())
+
+    def testFollow(self):
+        with tempfile.TemporaryFile('w+') as f:
+            lines = follow(f, poll_interval=0)
+            self.assertEqual(next(lines), '')
+            f.write('first\nsec')
+            f.flush()
+            f.seek(0)
+            self.assertEqual(next(lines), 'first\n')
+            self.assertEqual(next(lines), '')
+            position = f.tell()
+            f.write('ond\n')
+            f.flush()
+            f.seek(position)
+            self.assertEqual(next(lines), 'second\n')
+
+    def testAddressTable(self):
+        table = AddressTable()
+        addresses = ['10.1.1.1', '010.1.1.1', '300.1.1.1', '9.0.0.1',
+                     '10.1.1.1', '0.0.0.0']
+        ids = [table.intern(ip) for ip in addresses]
+        self.assertListEqual(ids, [0, 1, 2, 3, 0, 4])
+        self.assertListEqual([table.name(entry) for entry in ids], addresses)
+        self.assertEqual(table.addresses[0], 0x0a010101)
+
+        top = LexicographicTop(table.name)
+        top.add(ids[0])
+        top.add(ids[3])
+        self.assertEqual(top.get_top(), '9.0.0.1')
+
+    def testAsyncCollector(self):
+        lines = ['10.0.0.%d - - [%02d/Feb/2013:06:37:31 +0600] "GET /%s '
+                 'HTTP/1.1" 200 1046 "http://192.168.65.101/" "%s" %d\n'
+                 % (number % 7, 17 + number % 3, number % 11, number % 5,
+                    number * 13)
+                 for number in range(3000)]
+        expected = make_stat()
+        for line in lines:
+            expected.add_line(line)
+
+        async def collect(filename):
+            collector = AsyncCollector(batch_size=64, max_batches=2)
+            left, right = socketpair()
+
+            async def write():
+                writer = (await asyncio.open_unix_connection(sock=left))[1]
+                for line in lines[1000:]:
+                    writer.write(line.encode())
+                    await writer.drain()
+                writer.close()
+
+            await asyncio.gather(collector.add_file(filename),
+                                 collector.add_unix_socket(sock=right),
+                                 write())
+            await collector.close()
+            return await collector.results()
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log')
+            with open(filename, 'w') as f:
+                f.writelines(lines[:1000])
+            results = asyncio.run(collect(filename))
+
+        self.assertDictEqual(results, expected.results())
+
+    def testAsyncCollectorBadLines(self):
+        line = '10.0.0.1 - - [%s/Feb/2013:06:37:31 +0600] "GET /a ' \
+               'HTTP/1.1" 200 1046 "http://192.168.65.101/" "A" 100\n'
+        lines = [line % '17', line % '31', line % '18'] * 100
+
+        async def collect(filename):
+            collector = AsyncCollector(batch_size=7, max_batches=1)
+            await collector.add_file(filename)
+            await asyncio.wait_for(collector.close(), 5)
+            return collector
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log')
+            with open(filename, 'w') as f:
+                f.writelines(lines)
+            collector = asyncio.run(collect(filename))
+
+        expected = make_stat()
+        for line in lines[::3] + lines[2::3]:
+            expected.add_line(line)
+        self.assertEqual(collector.rejected, 100)
+        self.assertDictEqual(collector.parser.results(), expected.results())
+
+        async def fail():
+            collector = AsyncCollector(batch_size=2, max_batches=1)
+            collector.parser.add_line = None
+            collector.start()
+            for _ in range(5):
+                await collector.queue.put([lines[0]])
+            await asyncio.wait_for(collector.close(), 5)
+
+        self.assertRaises(TypeError, asyncio.run, fail())
+
+    def testCheckpoints(self):
+        lines = ['10.0.0.%d - - [%02d/Feb/2013:06:37:31 +0600] "GET /%d '
+                 'HTTP/1.1" 200 1046 "http://192.168.65.101/" "%d" %d\n'
+                 % (number % 7, 17 + number % 3, number % 11, number % 5,
+                    number * 13 % 1000) for number in range(1000)]
+        add_line = Parser.add_line
+        added = []
+
+        def interrupted(parser, line):
+            if len(added) == 550:
+                raise KeyboardInterrupt
+            added.append(line)
+            add_line(parser, line)
+
+        def run(filename, checkpoint):
+            return logstat.parse_with_checkpoints(filename, checkpoint,
+                                                  0).results()
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(logstat, 'CHECKPOINT_LINES', 100):
+            filename = os.path.join(directory, 'log')
+            checkpoint = os.path.join(directory, 'checkpoint')
+            with open(filename, 'w') as f:
+                f.writelines(lines)
+            expected = run(filename, checkpoint)
+            self.assertFalse(os.path.exists(checkpoint))
+
+            with mock.patch.object(Parser, 'add_line', interrupted):
+                self.assertRaises(KeyboardInterrupt, run, filename,
+                                  checkpoint)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['checkpoint', 'log'])
+            parser, offset = Parser.load_checkpoint(
+                checkpoint, logstat.file_identity(filename))
+            self.assertEqual(offset, len(''.join(lines[:500])))
+            self.assertEqual(run(filename, checkpoint), expected)
+            self.assertFalse(os.path.exists(checkpoint))
+
+            added.clear()
+            with mock.patch.object(Parser, 'add_line', interrupted):
+                self.assertRaises(KeyboardInterrupt, run, filename,
+                                  checkpoint)
+            other = [line.replace('"GET /', '"GET /x') for line in lines]
+            with open(filename, 'w') as f:
+                f.writelines(other)
+            self.assertRaises(ValueError, Parser.load_checkpoint,
+                              checkpoint, logstat.file_identity(filename))
+            fresh = Parser()
+            for line in other:
+                fresh.add_line(line)
+            self.assertEqual(run(filename, checkpoint), fresh.results())
+
+    def testShardedTies(self):
+        pages = ['/m', '/z', '/a']
+        lines = ['10.0.0.%d - - [%d/Feb/2013:06:37:31 +0600] "GET %s '
+                 'HTTP/1.1" 200 1046 "http://192.168.65.101/" "B%d"%s\n'
+                 % (number % 3, 17 + number % 2, pages[number % 3],
+                    number % 3, ' 500' if number % 5 else ' 0500')
+                 for number in range(90)]
+        lines[41] = lines[41].replace(' 500\n', '\n')
+        lines.insert(40, 'hi!\n')
+
+        expected = make_stat()
+        for line in lines:
+            expected.add_line(line)
+        results = expected.results()
+        self.assertEqual(results['SlowestAveragePage'], '/m')
+        self.assertEqual(results['MostPopularPage'], '/z')
+        self.assertEqual(results['MostActiveClient'], '10.0.0.2')
+        self.assertEqual(results['MostPopularBrowser'], 'B2')
+        self.assertEqual(results['SlowestPage'], '/a')
+        self.assertEqual(results['FastestPage'], '/a')
+        self.assertEqual(set(results['MostActiveClientByDay'].values()),
+                         {'10.0.0.2'})
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log')
+            with open(filename, 'w') as f:
+                f.writelines(lines)
+            for jobs in (1, 2, 3, 7):
+                for use_mmap in (False, True):
+                    parser = make_stat()
+                    parser.parse_file(filename, jobs, use_mmap)
+                    self.assertDictEqual(parser.results(), results)
+
+        for bounds in ((0, 10, 47, len(lines)), (0, 1, 89, len(lines)),
+                       (0, 45, 45, len(lines))):
+            merged = make_stat()
+            for start, end in zip(bounds, bounds[1:]):
+                shard = make_stat()
+                for line in lines[start:end]:
+                    shard.add_line(line)
+                merged.merge(shard)
+            self.assertDictEqual(merged.results(), results)
+
+    def testLogFollower(self):
+        spec = importlib.util.spec_from_file_location(
+            'logs_parser', os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                'logs', 'parser.py'))
+        logs_parser = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(logs_parser)
+        lines = ['10.0.0.%d - - [%02d/Feb/2013:06:37:31 +0600] "GET /%d '
+                 'HTTP/1.1" 200 1046 "http://192.168.65.101/" "ж%d" %d\n'
+                 % (number % 7, 17 + number % 3, number % 11, number % 5,
+                    number * 13) for number in range(600)]
+
+        def expect(follower, seen):
+            expected = make_stat()
+            for line in seen:
+                expected.add_line(line)
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                with follower.lock:
+                    if follower.parser.results() == expected.results():
+                        return
+                time.sleep(0.01)
+            with follower.lock:
+                self.assertDictEqual(follower.parser.results(),
+                                     expected.results())
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'access.log')
+            follower = logs_parser.LogFollower(filename, poll_interval=0.01)
+            thread = threading.Thread(target=follower.run)
+            thread.start()
+            try:
+                with open(filename, 'wb') as f:
+                    f.write(''.join(lines[:100]).encode())
+                    f.write(b'\xff\xfe broken\n')
+                    f.write(lines[100][:30].encode())
+                    f.flush()
+                    expect(follower, lines[:100])
+                    f.write(lines[100][30:].encode())
+                expect(follower, lines[:101])
+
+                os.rename(filename, filename + '.1')
+                with open(filename + '.1', 'a') as f:
+                    f.writelines(lines[101:200])
+                    f.write(lines[200][:-1])
+                with open(filename, 'w') as f:
+                    f.writelines(lines[201:400])
+                expect(follower, lines[:400])
+
+                with open(filename, 'w') as f:
+                    f.writelines(lines[400:450])
+                expect(follower, lines[:450])
+
+                with mock.patch.object(logs_parser, 'open', create=True,
+                                       side_effect=FileNotFoundError):
+                    os.rename(filename, filename + '.2')
+                    with open(filename, 'w') as f:
+                        f.writelines(lines[450:500])
+                    time.sleep(0.1)
+                with open(filename, 'a') as f:
+                    f.writelines(lines[500:])
+                expect(follower, lines)
+                self.assertTrue(thread.is_alive())
+            finally:
+                follower.stop()
+                thread.join()
+
+            path = os.path.join(directory, 'stats.sock')
+            with open(path, 'w') as f:
+                f.write('keep')
+            self.assertRaises(FileExistsError, logs_parser.serve_stats,
+                              path, follower)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'keep')
+
+            os.remove(path)
+            stale = socket.socket(socket.AF_UNIX)
+            stale.bind(path)
+            stale.close()
+            server = logs_parser.serve_stats(path, follower)
+            try:
+                with socket.socket(socket.AF_UNIX) as client:
+                    client.connect(path)
+                    self.assertIn(b'FastestPage', client.makefile('rb').read())
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def testCompressedLogs(self):
+        lines = ['10.0.0.%d - - [%02d/Feb/2013:06:37:31 +0600] "GET /%d '
+                 'HTTP/1.1" 200 1046 "http://192.168.65.101/" "%d" %d\n'
+                 % (number % 7, 17 + number % 3, number % 11, number % 5,
+                    number * 13 % 1000) for number in range(2000)]
+        data = ''.join(lines).encode()[:-1]
+
+        def parse_error(filename):
+            errors = []
+
+            def parse():
+                try:
+                    logstat.parse_log(filename)
+                except Exception as error:
+                    errors.append(error)
+
+            thread = threading.Thread(target=parse, daemon=True)
+            thread.start()
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(len(errors), 1)
+            return errors[0]
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(logstat, 'READ_BLOCK', 4096):
+            plain = os.path.join(directory, 'log')
+            with open(plain, 'wb') as f:
+                f.write(data)
+            expected = make_stat()
+            expected.parse_file(plain, 1)
+            expected = expected.results()
+
+            names = []
+            for suffix, module in (('.gz', gzip), ('.bz2', bz2),
+                                   ('.xz', lzma), ('.lzma', lzma)):
+                names.append(plain + suffix)
+                with module.open(names[-1], 'wb') as f:
+                    f.write(data)
+                self.assertTrue(logstat.is_compressed(names[-1]))
+                self.assertDictEqual(logstat.parse_log(names[-1]).results(),
+                                     expected)
+            for jobs in (1, 2):
+                parser = make_stat()
+                parser.parse_files(names, jobs)
+                merged = make_stat()
+                for _ in names:
+                    merged.parse_file(plain, 1)
+                self.assertDictEqual(parser.results(), merged.results())
+
+            compressed = gzip.compress(data)
+            corrupt = os.path.join(directory, 'corrupt.gz')
+            with open(corrupt, 'wb') as f:
+                f.write(compressed[:len(compressed) // 2] + b'\0' * 64 +
+                        compressed[len(compressed) // 2 + 64:])
+            parse_error(corrupt)
+            with open(corrupt, 'wb') as f:
+                f.write(compressed[:len(compressed) // 2])
+            self.assertIsInstance(parse_error(corrupt),
+                                  EOFError)
+
+            invalid = os.path.join(directory, 'invalid.gz')
+            with gzip.open(invalid, 'wb') as f:
+                f.write(data.replace(b'[17/Feb', b'[31/Feb'))
+            threads = threading.active_count()
+            self.assertIsInstance(parse_error(invalid),
+                                  ValueError)
+            self.assertEqual(threading.active_count(), threads)
+
+    def testSinks(self):
+        for options, extra in (({}, {}),
+                               ({'percentiles': True},
+                                {'LatencyPercentiles': {'50': 7, '95': 34,
+                                                        '99': 34},
+                                 'SlowestP99Page': '/a'}),
+                               ({'approximate': True},
+                                {'DistinctClientsByDay': {
+                                    '2013-02-17': 1, '2013-12-01': 2,
+                                    '2099-12-01': 1}})):
+            parser = Parser(**options)
+            for line in TOKENIZER_CORPUS:
+                parser.add_line(line)
+            results = parser.results()
+            self.assertDictEqual(parser.report(DictSink()).results, results)
+
+            output = io.StringIO()
+            parser.report(JsonSink(output))
+            self.assertEqual(output.getvalue().count('\n'), 1)
+            emitted = json.loads(output.getvalue())
+            self.assertDictEqual(emitted['MostActiveClientByDay'], {
+                '2013-02-17': '192.168.65.56', '2013-12-01': '1.2.3.4',
+                '2099-12-01': '1.2.3.4'})
+            self.assertEqual(emitted['FastestPage'], '/ж')
+            self.assertEqual(set(emitted), set(TextSink.FIELDS) | set(extra))
+            for key, value in extra.items():
+                self.assertEqual(emitted[key], value)
+
+            output = io.StringIO()
+            parser.report(TextSink(output))
+            text = output.getvalue()
+            self.assertIn('  2013-12-01: 1.2.3.4\n', text)
+            for key in extra:
+                self.assertIn('\n%s: %s\n' % (key, results[key]), text)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log')
+            with open(filename, 'w') as f:
+                f.write('\n'.join(TOKENIZER_CORPUS))
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  os.pardir, 'logs', 'parser.py')
+            output = subprocess.run(
+                [sys.executable, script, '--format', 'json', filename],
+                stdout=subprocess.PIPE, check=True).stdout.decode()
+            expected = make_stat()
+            with open(filename) as f:
+                for line in f:
+                    expected.add_line(line)
+        self.assertDictEqual(json.loads(output),
+                             JsonSink.convert(expected.results()))
+
+    def testMemoryMappedFile(self):
+        lines = ['192.168.65.56 - - [17/Feb/2013:06:37:31 +0600] "GET /a '
+                 'HTTP/1.1" 200 1046 "http://192.168.65.101/" "ABC" 27979',
+                 '192.168.65.57 - - [18/Feb/2013:06:38:31 +0600] "GET /б '
+                 'HTTP/1.1" 200 1046 "http://192.168.65.101/" "Браузер"',
+                 'hi!',
+                 '192.168.65.57 - - [18/Feb/2013:06:39:31 +0600] "GET /a '
+                 'HTTP/1.1" 200 1046 "http://192.168.65.101/" "BCD" 100']
+        expected = make_stat()
+        for line in lines:
+            expected.add_line(line)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log')
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines))
+            parser = make_stat()
+            parser.add_file(filename)
+
+            empty = os.path.join(directory, 'empty')
+            open(empty, 'w').close()
+            empty_parser = make_stat()
+            empty_parser.add_file(empty)
+
+        self.assertDictEqual(parser.results(), expected.results())
+        self.assertDictEqual(empty_parser.results(), make_stat().results())
+
+    def testMemoryMappedNonAscii(self):
+        wide = ['1.2.3.٤ - - [01/Dec/2013:23:59:59 +0000] "GET /x HTTP/1.0" '
+                '1 2 "-" "B" 1',
+                '1.2.3.4 - - [01/Dec/2013:23:59:59 +0000] "GET /x\xa0y '
+                'HTTP/1.0" 1 2 "-" "B" 2',
+                '1.2.3.4 - - [0٣/Dec/2013:23:59:59 +0000] "GET /z HTTP/1.0" '
+                '1 2 "-" "B" 3']
+        lines = TOKENIZER_CORPUS + wide + [
+            line.replace('ABC', 'A' + char + 'C').replace('/a ', '/a' + char)
+            for line in TOKENIZER_CORPUS[:2] for char in '٤\xa0ж\u2003']
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log')
+            with open(filename, 'w', encoding='utf-8', newline='') as f:
+                f.write('\n'.join(lines))
+            expected = make_stat()
+            with open(filename, encoding='utf-8', newline='\n') as f:
+                for line in f:
+                    expected.add_line(line)
+            parser = make_stat()
+            parser.add_file(filename)
+            sharded = make_stat()
+            sharded.parse_file(filename, 3, use_mmap=True)
+
+        self.assertEqual(len(parser.addresses), len(expected.addresses))
+        self.assertDictEqual(parser.results(), expected.results())
+        self.assertDictEqual(sharded.results(), expected.results())
+
+    def testRollingWindow(self):
+        line = ('10.0.0.%d - - [17/Feb/2013:06:%02d:%02d +0600] "GET /%s '
+                'HTTP/1.1" 200 1046 "http://192.168.65.101/" "ABC"%s')
+        parser = make_stat()
+        window = parser.add_window(60, 10)
+        parser.add_line(line % (1, 0, 5, 'a', ' 100'))
+        parser.add_line(line % (2, 0, 15, 'b', ' 300'))
+        parser.add_line(line % (2, 0, 30, 'a', ''))
+        self.assertDictEqual(window.results(2), {
+            'MostActiveClients': [('10.0.0.2', 2), ('10.0.0.1', 1)],
+            'MostPopularPages': [('/a', 2), ('/b', 1)],
+            'SlowestAveragePages': [('/b', 300.0), ('/a', 50.0)]})
+
+        parser.add_line(line % (3, 1, 10, 'c', ' 5'))
+        self.assertEqual(window.top_pages(3), [('/c', 1), ('/a', 1)])
+        parser.add_line(line % (1, 0, 0, 'a', ' 7'))
+        self.assertEqual(window.most_active_clients(),
+                         [('10.0.0.3', 1)])
+        window.advance(date(2013, 2, 17).toordinal() * 86400 + 6 * 3600 +
+                       30 * 60)
+        self.assertDictEqual(window.results(), {
+            'MostActiveClients': [], 'MostPopularPages': [],
+            'SlowestAveragePages': []})
+        self.assertRaises(ValueError, RollingWindow, 60, 7)
+        self.assertDictEqual(parser.results(), {
+            'FastestPage': '/c', 'MostActiveClient': '10.0.0.2',
+            'MostActiveClientByDay': {date(2013, 2, 17): '10.0.0.2'},
+            'MostPopularBrowser': 'ABC', 'MostPopularPage': '/a',
+            'SlowestAveragePage': '/b', 'SlowestPage': '/b'})
+
+    def testLatencyPercentiles(self):
+        line = ('10.0.0.1 - - [17/Feb/2013:06:37:31 +0600] "GET /%s '
+                'HTTP/1.1" 200 1046 "http://192.168.65.101/" "ABC" %d')
+        parser = Parser(percentiles=True)
+        shards = [Parser(percentiles=True) for _ in range(3)]
+        lines = [line % ('steady', 200) for _ in range(100)] + \
+                [line % ('tail', 1) for _ in range(98)] + \
+                [line % ('tail', 5000) for _ in range(2)] + \
+                [line % ('spread', time) for time in range(301)]
+        for number, log_line in enumerate(lines):
+            parser.add_line(log_line)
+            shards[number % 3].add_line(log_line)
+
+        results = parser.results()
+        self.assertEqual(results['SlowestAveragePage'], '/steady')
+        self.assertEqual(results['SlowestP99Page'], '/tail')
+        for value in parser.page_percentiles('/steady').values():
+            self.assertAlmostEqual(value, 200, delta=2)
+        self.assertAlmostEqual(parser.page_percentiles('/tail')[99], 5000,
+                               delta=50)
+        for percent, value in parser.page_percentiles('/spread').items():
+            self.assertAlmostEqual(value, percent * 3,
+                                   delta=percent * 0.03 + 1)
+        self.assertEqual(parser.page_percentiles('/missing'), {})
+
+        merged = LatencySketch()
+        for shard in shards:
+            merged.merge(shard.latencies[shard.urls.ids['/spread']])
+        whole = parser.latencies[parser.urls.ids['/spread']]
+        self.assertEqual(merged.buckets, whole.buckets)
+        self.assertEqual(merged.percentiles(), whole.percentiles())
+        self.assertRaises(ValueError, merged.merge, LatencySketch(0.05))
+
+        self.assertDictEqual(Parser(percentiles=True).results(),
+                             dict(make_stat().results(),
+                                  LatencyPercentiles={}, SlowestP99Page=''))
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'access.log')
+            with open(filename, 'w') as f:
+                f.write('\n'.join(lines))
+            for jobs in (1, 3):
+                for use_mmap in (False, True):
+                    sharded = Parser(percentiles=True)
+                    sharded.parse_file(filename, jobs, use_mmap)
+                    self.assertDictEqual(sharded.results(), results)
+                sharded = Parser(percentiles=True)
+                sharded.parse_files([filename] * 2, jobs)
+                doubled = Parser(percentiles=True)
+                for log_line in lines * 2:
+                    doubled.add_line(log_line)
+                self.assertDictEqual(sharded.results(), doubled.results())
+
+            approximate = Parser(approximate=True)
+            self.assertRaises(ValueError, approximate.parse_file, filename, 2)
+            self.assertRaises(ValueError, approximate.parse_files,
+                              [filename] * 2, 2)
+            windowed = Parser()
+            windowed.add_window(60, 10)
+            self.assertRaises(ValueError, windowed.parse_file, filename, 2)
+
+    def testApproximateMode(self):
+        rng = random.Random(2013)
+        line = ('10.%d.%d.%d - - [%02d/Feb/2013:06:37:31 +0600] "GET /%s '
+                'HTTP/1.1" 200 1046 "http://192.168.65.101/" "%s" %d')
+        exact = make_stat()
+        approximate = Parser(approximate=True)
+        log_lines = []
+        for number in range(20000):
+            if number % 4:
+                client = (rng.randrange(256), rng.randrange(256),
+                          rng.randrange(256))
+                page = 'bot/%d' % rng.randrange(10 ** 6)
+            else:
+                client, page = (0, 0, 1), 'index'
+            log_line = line % (client + (17 + number // 10000, page,
+                                         'Bot' if number % 3 else 'Human',
+                                         1000 if page == 'index' else 1))
+            exact.add_line(log_line)
+            approximate.add_line(log_line)
+            log_lines.append(log_line)
+
+        results = approximate.results()
+        distinct = results.pop('DistinctClientsByDay')
+        self.assertDictEqual(results, exact.results())
+        for day, clients in distinct.items():
+            actual = len(exact.days[day.toordinal()].results)
+            self.assertAlmostEqual(clients, actual, delta=actual * 0.05)
+        self.assertLessEqual(len(approximate.most_active_clients.candidates),
+                             HEAVY_HITTERS)
+
+        text = '\n'.join(log_lines) + '\n'
+        from_stdin = Parser(approximate=True)
+        with mock.patch('sys.stdin', io.StringIO(text)):
+            from_stdin.parse()
+        from_mmap = Parser(approximate=True)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'access.log')
+            with open(filename, 'w') as f:
+                f.write(text)
+            from_mmap.parse_mmap(filename)
+        for parser in (from_stdin, from_mmap):
+            self.assertEqual(parser.slowest_average_page,
+                             exact.slowest_average_page)
+            self.assertDictEqual(parser.results(), approximate.results())
+
+        small = HyperLogLog()
+        for address in ('1.1.1.1', '2.2.2.2', '1.1.1.1', '3.3.3.3'):
+            small.add(address)
+        self.assertEqual(small.estimate(), 3)
+        self.assertDictEqual(Parser(approximate=True).results(),
+                             dict(make_stat().results(),
+                                  DistinctClientsByDay={}))
+        self.assertRaises(ValueError, Parser, approximate=True,
+                          incremental=True)
+
+    def testInstrumentation(self):
+        parser = Parser(instrumented=True)
+        expected = make_stat()
+        for line in TOKENIZER_CORPUS:
+            parser.add_line(line)
+            expected.add_line(line)
+        self.assertDictEqual(parser.results(), expected.results())
+        self.assertIsNone(expected.metrics)
+
+        metrics = parser.metrics.as_dict()
+        accepted = sum(expected.most_popular_pages.results)
+        self.assertDictEqual(metrics['counters'], {
+            'lines_accepted': accepted,
+            'lines_rejected': len(TOKENIZER_CORPUS) - accepted})
+        self.assertEqual(metrics['timers']['extract_info']['calls'],
+                         len(TOKENIZER_CORPUS))
+        for name in ('update_stats', 'add_page', 'intern_urls',
+                     'top_most_active_clients', 'top_days'):
+            self.assertEqual(metrics['timers'][name]['calls'], accepted)
+        self.assertEqual(metrics['gauges']['keys']['table=urls'],
+                         len(expected.urls.names))
+
+        text = parser.metrics.prometheus()
+        self.assertIn('log_parser_lines_accepted_total %d\n' % accepted,
+                      text)
+        self.assertIn('log_parser_calls_total{stage="day_ordinal"} %d\n'
+                      % accepted, text)
+        self.assertIn('log_parser_keys{table="days"} %d\n'
+                      % len(expected.days), text)
+        self.assertIs(parser.instrument(), parser.metrics)
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint')
+            parser.save_checkpoint(checkpoint, 10)
+            restored, offset = Parser.load_checkpoint(checkpoint)
+        self.assertEqual(offset, 10)
+        self.assertIsNone(restored.metrics)
+        self.assertDictEqual(restored.results(), expected.results())
+        for line in TOKENIZER_CORPUS:
+            restored.add_line(line)
+            parser.add_line(line)
+            expected.add_line(line)
+        self.assertDictEqual(restored.results(), expected.results())
+        self.assertDictEqual(parser.results(), expected.results())
+        self.assertEqual(parser.metrics.as_dict()['counters'][
+            'lines_accepted'], 2 * accepted)
+        for top in restored.days.values():
+            self.assertNotIn('add', vars(top))
+
+        late = make_stat()
+        for line in TOKENIZER_CORPUS:
+            late.add_line(line)
+        metrics = late.instrument()
+        for line in TOKENIZER_CORPUS + [
+                line.replace('2013', '2014') for line in TOKENIZER_CORPUS]:
+            late.add_line(line)
+        accepted_late = sum(late.most_popular_pages.results) - accepted
+        self.assertGreater(len(late.days), len(expected.days))
+        self.assertEqual(metrics.timers['top_days'][0], accepted_late)
+
+    def testColumns(self):
+        rng = random.Random(2013)
+        corpus = TOKENIZER_CORPUS + [mutate(line, rng)
+                                     for line in TOKENIZER_CORPUS[:8]
+                                     for _ in range(200)]
+        for line in corpus[:]:
+            try:
+                make_stat().add_line(line)
+            except ValueError:
+                corpus.remove(line)
+        expected = make_stat()
+        for line in corpus:
+            expected.add_line(line)
+
+        parser = make_stat()
+        batches = list(parser.column_batches(corpus, 300))
+        self.assertEqual(len(batches), math.ceil(len(corpus) / 300))
+        columns = batches[0]
+        for batch in batches[1:]:
+            columns.extend(batch)
+        self.assertDictEqual(columns.results(), expected.results())
+        self.assertEqual(len(columns),
+                         sum(expected.most_popular_pages.results))
+        self.assertEqual(parser.results(), make_stat().results())
+
+        first = columns.clients[0]
+        self.assertEqual(
+            inet_ntop(AF_INET, columns.ips[0].to_bytes(4, 'big')),
+            columns.address_table.name(first))
+        self.assertEqual(list(compress(columns.times, columns.time_mask)),
+                         [int(info['time']) for info
+                          in map(parser.extract_info, corpus)
+                          if info and info['time']])
+        self.assertDictEqual(make_stat().parse_columns([]).results(),
+                             make_stat().results())
+        self.assertRaises(ValueError, columns.extend,
+                          make_stat().parse_columns([]))
+
+        mixed = make_stat()
+        mixed.parse_columns(corpus[::2])
+        for line in corpus:
+            mixed.add_line(line)
+        mixed.add_columns(mixed.parse_columns(corpus[1::2]))
+        for line in corpus[1::2]:
+            expected.add_line(line)
+        self.assertDictEqual(mixed.results(), expected.results())
+
+    def testParsedCache(self):
+        lines = TOKENIZER_CORPUS[:7] + [
+            '10.0.0.%d - - [%02d/Feb/2013:06:37:%02d +0600] "GET /%d '
+            'HTTP/1.1" 200 1046 "http://192.168.65.101/" "ABC"%s'
+            % (number % 5, 17 + number % 3, number % 60, number % 4,
+               ' %d' % number if number % 6 else '')
+            for number in range(100)] + ['hi!', '1.2.3.999 - - '
+                                          '[17/Feb/2013:06:37:31 +0600] "GET '
+                                          '/x HTTP/1.1" 1 2 "-" "B" 1']
+        expected = make_stat()
+        for line in lines:
+            expected.add_line(line)
+        before = expected.results()
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log')
+            with open(filename, 'w') as f:
+                f.write('\n'.join(lines))
+            first = make_stat()
+            first.add_cached_file(filename)
+            self.assertTrue(os.path.exists(filename + CACHE_SUFFIX))
+
+            second = make_stat()
+            second.pattern = None
+            columns = second.add_cached_file(filename)
+            self.assertIsInstance(columns.pages, memoryview)
+            self.assertDictEqual(columns.results(), before)
+
+            cache = filename + CACHE_SUFFIX
+            with open(cache, 'rb') as f:
+                saved = f.read()
+            table = logstat.CACHE_HEADER.size
+            urls = struct.unpack_from('<Q', saved, table)[0]
+            for damaged in (saved[:-3], saved[:table + 20],
+                            saved[:table] + struct.pack('<Q', 1 << 40) +
+                            saved[table + 8:],
+                            saved[:urls] + b'\xff' + saved[urls + 1:]):
+                with open(cache, 'wb') as f:
+                    f.write(damaged)
+                self.assertIsNone(logstat.Columns.load(cache, filename))
+                repaired = make_stat()
+                repaired.add_cached_file(filename)
+                self.assertDictEqual(repaired.results(), before)
+                with open(cache, 'rb') as f:
+                    self.assertEqual(f.read(), saved)
+
+            incremental = Parser(incremental=True)
+            incremental.add_cached_file(filename)
+
+            with open(filename, 'a') as f:
+                f.write('\n' + lines[0])
+            os.utime(filename, ns=(0, 0))
+            expected.add_line(lines[0])
+            third = make_stat()
+            third.add_cached_file(filename)
+            del columns
+
+        for parser in (first, second, incremental):
+            self.assertDictEqual(parser.results(), before)
+        self.assertDictEqual(third.results(), expected.results())
+
+    def testGeneratedLogs(self):
+        lines = list(loggen.generate(3000, seed=7, malformed_lines=0))
+        broken = list(loggen.generate(3000, seed=7, malformed_lines=1))
+        stat = make_stat()
+        self.assertTrue(all(map(stat.extract_info, lines)))
+        self.assertFalse(any(map(stat.extract_info, broken)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Замеры скорости общего ядра разбора логов (logstat.Parser, на котором
+работают и logs/parser.py, и classes/parser.py) в разных режимах на
+синтетическом логе из loggen.py. Для каждого режима измеряются строки в
+секунду целиком, время этапов (разбор строк, update_stats, обновление
+топов, итоговые результаты) и пиковый объём памяти процесса. Каждый замер
+идёт в отдельном, заново запущенном процессе, а файл читается потоком,
+поэтому пиковая память относится к самому парсеру. Результаты выводятся в
+JSON; с --compare печатается изменение относительно сохранённого прошлого
+запуска.
+Использование: parser_bench.py [-n строк] [--seed число] [--mode режим]
+                               [-o результаты.json]
+                               [--compare прошлые.json] [файл с логами]
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+from loggen import generate
+import logstat
+
+MODES = {'exact': {}, 'incremental': {'incremental': True},
+         'approximate': {'approximate': True}}
+
+
+def measure_total(mode: str, filename: str) -> dict:
+    """Полный разбор файла через add_line: строки в секунду, объём памяти
+    процесса до разбора и пиковый."""
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    parser = logstat.Parser(**MODES[mode])
+    lines = 0
+    start = time.perf_counter()
+    with open(filename) as f:
+        for line in f:
+            parser.add_line(line)
+            lines += 1
+    parser.results()
+    elapsed = time.perf_counter() - start
+    return {'lines': lines, 'seconds': elapsed,
+            'lines_per_second': lines / elapsed,
+            'start_rss_kb': start_rss,
+            'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss}
+
+
+def measure_stages(mode: str, filename: str) -> dict:
+    """Время этапов при том же разборе через add_line, снятое метриками
+    Parser.instrument(): extract_info, update_stats целиком и вложенные в
+    него обновления топов парсера (add у его счётчиков), add_page,
+    интернирование и перевод дат, а также итоговые результаты. Обёртки
+    метрик добавляют свои накладные расходы, поэтому сумма этапов больше
+    времени из measure_total."""
+    parser = logstat.Parser(**MODES[mode])
+    metrics = parser.instrument()
+    with open(filename) as f:
+        for line in f:
+            parser.add_line(line)
+
+    start = time.perf_counter()
+    parser.results()
+    results = time.perf_counter() - start
+
+    timers = metrics.as_dict()['timers']
+
+    def seconds(prefix: str) -> float:
+        return sum(timer['seconds'] for name, timer in timers.items()
+                   if name.startswith(prefix))
+
+    return {'extract_info': seconds('extract_info'),
+            'update_stats': seconds('update_stats'),
+            'tops': seconds('top_'), 'add_page': seconds('add_page'),
+            'intern': seconds('intern_'),
+            'day_ordinal': seconds('day_ordinal'), 'results': results,
+            'accepted': metrics.counters.get('lines_accepted', 0),
+            'rejected': metrics.counters.get('lines_rejected', 0)}
+
+
+def run(function, mode: str, filename: str) -> dict:
+    """Выполняет замер в новом процессе. Процесс запускается заново, а не
+    через fork, чтобы пиковая память не включала память этого процесса."""
+    with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, mode, filename).result()
+
+
+def change(old: float, new: float) -> str:
+    """Относительное изменение new по сравнению с old; если old нулевое,
+    то абсолютное."""
+    if old:
+        return '{:+.1%}'.format(new / old - 1)
+    return '{:+,.3f}'.format(new - old)
+
+
+def compare(results: dict, previous: dict) -> None:
+    """Печатает в stderr изменение скорости и памяти относительно прошлого
+    запуска."""
+    for name, result in results['modes'].items():
+        old = previous.get('modes', {}).get(name)
+        if old is None:
+            continue
+        for key in ('lines_per_second', 'peak_rss_kb'):
+            print('{}.{}: {:,.0f} -> {:,.0f} ({})'.format(
+                name, key, old[key], result[key],
+                change(old[key], result[key])), file=sys.stderr)
+        for stage, seconds in result['stages'].items():
+            if stage in old['stages'] and isinstance(seconds, float):
+                print('{}.{}: {:.3f}s -> {:.3f}s ({})'.format(
+                    name, stage, old['stages'][stage], seconds,
+                    change(old['stages'][stage], seconds)), file=sys.stderr)
+
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Замеры скорости разбора логов.')
+    arguments.add_argument('file', nargs='?',
+                           help='файл с логами; по умолчанию он генерируется '
+                                'loggen.py')
+    arguments.add_argument('-n', '--lines', type=int, default=200000,
+                           help='число строк синтетического лога')
+    arguments.add_argument('--seed', type=int, default=2013)
+    arguments.add_argument('--mode', choices=sorted(MODES), action='append',
+                           help='какие режимы парсера замерять (по '
+                                'умолчанию все)')
+    arguments.add_argument('-o', '--output',
+                           help='куда записать результаты (по умолчанию '
+                                'stdout)')
+    arguments.add_argument('--compare',
+                           help='результаты прошлого запуска для сравнения')
+    args = arguments.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = args.file
+        if filename is None:
+            filename = os.path.join(directory, 'synthetic.log')
+            with open(filename, 'w') as f:
+                for line in generate(args.lines, args.seed):
+                    f.write(line + '\n')
+
+        results = {'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'input': {'file': args.file, 'lines': args.lines,
+                             'seed': args.seed,
+                             'bytes': os.path.getsize(filename)},
+                   'modes': {}}
+        for mode in args.mode or sorted(MODES):
+            result = run(measure_total, mode, filename)
+            result['stages'] = run(measure_stages, mode, filename)
+            results['modes'][mode] = result
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Сравнение скорости разбора строк лога регулярным выражением Parser.pattern и
+Parser.extract_info, который отбрасывает строки без ' - - [' до применения
+выражения. По умолчанию строки генерируются loggen.py.
+Использование: tokenizer_bench.py [-n строк] [--seed число] [файл с логами]
+"""
+import argparse
+import time
+
+from loggen import generate
+from logstat import Parser
+
+
+def regex_info(parser: Parser, line: str) -> (None, dict):
+    """Разбор строки только регулярным выражением, без предварительной
+    проверки."""
+    data = parser.pattern.match(line)
+    return data.groupdict() if data else None
+
+
+def measure(function, parser: Parser, lines: list) -> float:
+    """Возвращает скорость разбора в строках в секунду."""
+    start = time.perf_counter()
+    for line in lines:
+        function(parser, line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Скорость разбора строк лога.')
+    arguments.add_argument('file', nargs='?',
+                           help='файл с логами; по умолчанию строки '
+                                'генерируются loggen.py')
+    arguments.add_argument('-n', '--lines', type=int, default=200000,
+                           help='число строк синтетического лога')
+    arguments.add_argument('--seed', type=int, default=2013)
+    args = arguments.parse_args()
+
+    if args.file:
+        with open(args.file) as f:
+            lines = f.readlines()
+    else:
+        lines = [line + '\n' for line in generate(args.lines, args.seed)]
+
+    for name, function in (('pattern', regex_info),
+                           ('extract_info', Parser.extract_info)):
+        print('{:>12}: {:>12,.0f} lines/sec'.format(
+            name, measure(function, Parser(), lines)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,186 +1,231 @@
 #!/usr/bin/env python3
-from datetime import datetime
+"""
+Консольная утилита для подсчёта статистики по логу сервера. Разбор и подсчёт
+выполняет общее ядро classes/logstat.py.
+"""
+import argparse
+import io
+import errno
+import os
+import socketserver
+import stat
 import sys
-import math
-import re
+import threading
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'classes'))
+from logstat import (JsonSink, Parser, READ_BLOCK, TextSink, is_compressed,
+                     parse_with_checkpoints)
 
-class Parser(object):
-    """
-    Класс парсера для обработки файла с логами.
-    """
-    def __init__(self) -> None:
-        """Инициализация класса."""
-        self.slowest_page = ''
-        self.slowest_page_time = 0
-
-        self.slowest_average_page = ''
-
-        self.fastest_page = ''
-        self.fastest_page_time = math.inf
-
-        self.pages = {}
-        self.browsers = {}
-        self.clients = {}
-        self.clients_by_days = {}
-        self.days = {}
-
-        self.most_popular_pages = LexicographicTop()
-        self.most_popular_agents = LexicographicTop()
-        self.most_active_clients = LexicographicTop()
-
-        self.pattern = re.compile('(?P<ip>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
-                                  ' - - \[(?P<date>\d{2}/(Jan|Feb|Mar|Apr|May|'
-                                  'Jun|Jul|Aug|Sep|Oct|Nov|Dec)/20\d{2}):[0-2]'
-                                  '[0-9]:[0-5]\d:[0-5]\d \+\d{4}] "(GET|PUT|'
-                                  'POST|HEAD|OPTIONS|DELETE) (?P<url>\S+) '
-                                  '\S+" \d+ \d+ "\S+" "(?P<browser>.+)"( '
-                                  '(?P<time>\d+)|)')
-
-    def parse(self) -> None:
-        """Основная функция обработки логов."""
-        for line in sys.stdin:
-            entry_info = self.extract_info(line)
-            if entry_info:
-                self.update_stats(entry_info)
-
-        self.find_slowest_average()
-
-    def extract_info(self, s: str) -> (None, dict):
-        """Проверяет корректность строки и извлекает из неё информацию.
-        Возвращает None в случае некорректной информации."""
-        data = re.match(self.pattern, s)
-        return data.groupdict() if data else None
-
-    def update_stats(self, data: dict) -> None:
-        """Обновляет данные в соответствии с новой информацией."""
-        if data['time']:
-            page_time = int(data['time'])
-
-            if page_time >= self.slowest_page_time:
-                self.slowest_page_time = page_time
-                self.slowest_page = data['url']
-
-            if page_time <= self.fastest_page_time:
-                self.fastest_page_time = page_time
-                self.fastest_page = data['url']
-
-            if data['url'] not in self.pages:
-                self.pages[data['url']] = Page(page_time)
-            else:
-                self.pages[data['url']].add_time(page_time)
-        else:
-            if data['url'] not in self.pages:
-                self.pages[data['url']] = Page(0)
-            else:
-                self.pages[data['url']].add_time(0)
-
-        if data['browser'] not in self.browsers:
-            self.browsers[data['browser']] = 1
-        else:
-            self.browsers[data['browser']] += 1
-
-        if data['ip'] not in self.clients:
-            self.clients[data['ip']] = 1
-        else:
-            self.clients[data['ip']] += 1
 
-        self.most_popular_pages.add_entry(data['url'],
-                                          self.pages[data['url']].hits)
-        self.most_popular_agents.add_entry(data['browser'],
-                                           self.browsers[data['browser']])
-        self.most_active_clients.add_entry(data['ip'],
-                                           self.clients[data['ip']])
+POLL_INTERVAL = 0.2
+SINKS = {'text': TextSink, 'json': JsonSink}
 
-        date = datetime.strptime(data['date'], '%d/%b/%Y').date()
 
-        if data['ip'] not in self.clients_by_days:
-            self.clients_by_days[data['ip']] = {}
-        if date not in self.clients_by_days[data['ip']]:
-            self.clients_by_days[data['ip']][date] = 1
-        else:
-            self.clients_by_days[data['ip']][date] += 1
-
-        if date not in self.days:
-            self.days[date] = LexicographicTop()
-        self.days[date].add_entry(data['ip'],
-                                  self.clients_by_days[data['ip']][date])
-
-    def find_slowest_average(self) -> None:
-        """Подсчитывает среднее время загрузки для каждой страницы и находит
-        страницу с самым наихудшим временем."""
-        slowest_average_page = ''
-        slowest_average_page_time = 0
-
-        for page in self.pages.keys():
-            average_time = self.pages[page].total_time / self.pages[page].hits
-            if average_time > slowest_average_page_time:
-                slowest_average_page_time = average_time
-                slowest_average_page = page
-
-        self.slowest_average_page = slowest_average_page
-
-    def print_stats(self) -> None:
-        """Выводит статистику в нужном формате на консоль."""
-        print('FastestPage: ' + self.fastest_page)
-        print('MostActiveClient: ' + self.most_active_clients.get_top())
-        print('MostActiveClientByDay: ')
-        for day in sorted(self.days.keys()):
-            print('  ' + str(day) + ': ' + self.days[day].get_top())
-        print()
-        print('MostPopularBrowser: ' + self.most_popular_agents.get_top())
-        print('MostPopularPage: ' + self.most_popular_pages.get_top())
-        print('SlowestAveragePage: ' + self.slowest_average_page)
-        print('SlowestPage: ' + self.slowest_page + '\n')
-
-
-class Page(object):
+class LogFollower(object):
     """
-    Класс страницы. Используется для подсчета количества загрузок конкретной
-    страницы и суммарного времени, затраченного на её открытие.
+    Следит за файлом с логами, в который продолжают дописывать строки, как
+    tail -F. Новые байты читаются блоками по READ_BLOCK и разбираются сразу;
+    когда данных нет, раз в poll_interval секунд проверяется, не был ли
+    файл усечён (тогда он читается с начала) или переименован при ротации
+    (тогда старый файл дочитывается и открывается новый по тому же имени).
+    Статистика обновляется под блокировкой lock, чтобы её можно было
+    запрашивать из других потоков (см. stats) и выводить приёмником sink.
+    Некорректные байты UTF-8 заменяются, а не прерывают слежение.
     """
-    def __init__(self, time: int) -> None:
-        """Инициализация. Изначально к сумме прибавляется первое время загрузки
-        создаваемой страницы."""
-        self.total_time = time
-        self.hits = 1
-
-    def add_time(self, time: int) -> None:
-        """Прибавляет новое время загрузки к суммарному для страницы."""
-        self.total_time += time
-        self.hits += 1
-
-
-class LexicographicTop(object):
+    def __init__(self, filename: str, parser: Parser = None,
+                 poll_interval: float = POLL_INTERVAL,
+                 sink=TextSink) -> None:
+        """Инициализация."""
+        self.filename = filename
+        self.parser = parser or Parser()
+        self.poll_interval = poll_interval
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.file = None
+        self.inode = None
+        self.rest = b''
+
+    def open(self) -> bool:
+        """Открывает файл по имени вместо открытого ранее. Возвращает False,
+        если файла пока нет (например, сразу после ротации); тогда прежний
+        файл остаётся открытым."""
+        try:
+            file = open(self.filename, 'rb', buffering=0)
+        except FileNotFoundError:
+            return False
+        if self.file is not None:
+            self.file.close()
+        self.file = file
+        stat = os.fstat(self.file.fileno())
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.rest = b''
+        return True
+
+    def read_available(self) -> bool:
+        """Читает и разбирает всё, что дописано в файл. Возвращает True,
+        если были новые данные."""
+        read = False
+        while True:
+            block = self.file.read(READ_BLOCK)
+            if not block:
+                return read
+            read = True
+            block = self.rest + block
+            end = block.rfind(b'\n') + 1
+            self.rest = block[end:]
+            lines = block[:end].decode(errors='replace').split('\n')[:-1]
+            with self.lock:
+                for line in lines:
+                    self.parser.add_line(line)
+
+    def check_rotation(self) -> None:
+        """Проверяет, не был ли файл переименован или усечён. Если новый
+        файл исчез до открытия, он будет открыт при следующей проверке."""
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return
+        if (stat.st_dev, stat.st_ino) != self.inode:
+            self.read_available()
+            if self.rest:
+                with self.lock:
+                    self.parser.add_line(self.rest.decode(errors='replace'))
+                self.rest = b''
+            self.open()
+        elif stat.st_size < self.file.tell():
+            self.file.seek(0)
+            self.rest = b''
+
+    def run(self) -> None:
+        """Следит за файлом, пока не будет вызван stop."""
+        while not self.open():
+            if self.stopped.wait(self.poll_interval):
+                return
+        try:
+            while not self.stopped.is_set():
+                if not self.read_available():
+                    self.check_rotation()
+                    self.stopped.wait(self.poll_interval)
+        finally:
+            self.file.close()
+            self.file = None
+
+    def stop(self) -> None:
+        """Останавливает run."""
+        self.stopped.set()
+
+    def stats(self) -> str:
+        """Возвращает текущую статистику в формате приёмника sink."""
+        output = io.StringIO()
+        with self.lock:
+            self.parser.report(self.sink(output))
+        return output.getvalue()
+
+
+class StatsHandler(socketserver.StreamRequestHandler):
     """
-    Структура для поддержания топа в наборе элементов. При запросе самого
-    популярного объекта возвращает лексикографически наименьшую единицу.
+    Отвечает на подключение к unix-сокету текущей статистикой.
     """
-    def __init__(self) -> None:
-        """Инициализация."""
-        self.top_entries = []
-        self.top_result = 0
-
-    def add_entry(self, entry: str, entry_result: int) -> None:
-        """Добавляет новый элемент к топу. Если результат элемента лучше
-        имеющегося, список лучших элементов очищается, иначе элемент
-        добавляется в топ."""
-        if entry_result == self.top_result:
-            self.top_entries.append(entry)
-        elif entry_result > self.top_result:
-            self.top_result = entry_result
-            self.top_entries.clear()
-            self.top_entries.append(entry)
-
-    def get_top(self) -> str:
-        """Возвращает лучший наименьший лексикографичеки элемент."""
-        return sorted(self.top_entries, reverse=True)[0]
+    def handle(self) -> None:
+        """Отправляет статистику и закрывает соединение."""
+        self.wfile.write(self.server.follower.stats().encode())
+
+
+def serve_stats(path: str,
+                follower: LogFollower) -> socketserver.UnixStreamServer:
+    """Запускает в отдельном потоке сервер, который отдаёт статистику
+    follower каждому подключившемуся к unix-сокету path. Оставшийся от
+    прошлого запуска сокет удаляется; если path занят чем-то другим,
+    возбуждается FileExistsError."""
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise FileExistsError(errno.EEXIST, 'not a socket', path)
+        os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, StatsHandler)
+    server.daemon_threads = True
+    server.follower = follower
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def follow_log(filename: str, socket_path: str = None,
+               poll_interval: float = POLL_INTERVAL, sink=TextSink) -> Parser:
+    """Следит за файлом с логами до прерывания (Ctrl+C), при заданном
+    socket_path отдавая через него текущую статистику."""
+    follower = LogFollower(filename, poll_interval=poll_interval, sink=sink)
+    server = serve_stats(socket_path, follower) if socket_path else None
+    try:
+        follower.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            os.remove(socket_path)
+
+    return follower.parser
 
 
 def main():
-    parser = Parser()
-    parser.parse()
-    parser.print_stats()
+    arguments = argparse.ArgumentParser(
+        description='Статистика по логу сервера.')
+    arguments.add_argument('files', nargs='*', metavar='file',
+                           help='файлы с логами, в том числе сжатые gzip, '
+                                'bzip2 или xz; по умолчанию читается stdin')
+    arguments.add_argument('-j', '--jobs', type=int, default=None,
+                           help='число процессов для обработки файлов')
+    arguments.add_argument('--mmap', action='store_true',
+                           help='отображать файл в память и разбирать его '
+                                'байтовым регулярным выражением')
+    arguments.add_argument('--checkpoint',
+                           help='файл контрольной точки: обработка файла идёт '
+                                'в одном процессе и продолжается с места, на '
+                                'котором прервался предыдущий запуск')
+    arguments.add_argument('--checkpoint-interval', type=float, default=60.0,
+                           help='период сохранения контрольной точки, сек')
+    arguments.add_argument('-f', '--follow', action='store_true',
+                           help='следить за дописываемым файлом, учитывая '
+                                'ротацию и усечение, до Ctrl+C')
+    arguments.add_argument('--socket',
+                           help='unix-сокет, через который в режиме '
+                                '--follow отдаётся текущая статистика')
+    arguments.add_argument('--poll-interval', type=float,
+                           default=POLL_INTERVAL,
+                           help='период проверки файла в режиме --follow, '
+                                'сек')
+    arguments.add_argument('--format', choices=sorted(SINKS), default='text',
+                           help='формат вывода статистики')
+    args = arguments.parse_args()
+    if args.checkpoint and len(args.files) != 1:
+        arguments.error('--checkpoint требует ровно один файл')
+    if args.follow and (len(args.files) != 1 or
+                        is_compressed(args.files[0]) or args.checkpoint):
+        arguments.error('--follow требует ровно один несжатый файл')
+    if args.socket and not args.follow:
+        arguments.error('--socket работает только с --follow')
+    if args.socket and os.path.lexists(args.socket) and \
+            not stat.S_ISSOCK(os.lstat(args.socket).st_mode):
+        arguments.error('--socket: {} существует и не является '
+                        'сокетом'.format(args.socket))
+
+    if args.follow:
+        parser = follow_log(args.files[0], args.socket, args.poll_interval,
+                            SINKS[args.format])
+    elif args.checkpoint:
+        parser = parse_with_checkpoints(args.files[0], args.checkpoint,
+                                        args.checkpoint_interval)
+    else:
+        parser = Parser()
+        if len(args.files) == 1 and not is_compressed(args.files[0]):
+            parser.parse_file(args.files[0], args.jobs, args.mmap)
+        elif args.files:
+            parser.parse_files(args.files, args.jobs)
+        else:
+            parser.parse()
+    parser.report(SINKS[args.format]())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Индекс графа ссылок между вики-страницами, построенный по локальной выгрузке
+Википедии, для поиска цепочек без загрузки страниц. Граф хранится в формате
+CSR: для каждой страницы смещение её ссылок (int32) в общем массиве номеров
+страниц (int32), а также такие же массивы обратных ссылок и отсортированная
+таблица названий. Файл отображается в память, поэтому открывается сразу.
+Использование: linkgraph.py build [--html] выгрузка граф
+               linkgraph.py chain граф < пары_названий
+"""
+from urllib.parse import unquote
+from array import array
+from bisect import bisect_left
+import xml.etree.ElementTree as ElementTree
+import argparse
+import bz2
+import gzip
+import mmap
+import os
+import re
+import struct
+import sys
+
+from phil import extract_content, extract_links
+
+
+GRAPH_MAGIC = b'PHILCSR' + sys.byteorder[:1].encode()
+GRAPH_VERSION = 1
+GRAPH_HEADER = struct.Struct('<8sIII')
+INT32_MAX = 2 ** 31 - 1
+WIKILINK = re.compile(r'\[\[([^\[\]|#:]+)[]|#]')
+
+
+def normalize(title):
+    """
+    Функция приводит название статьи к виду, в котором оно встречается
+    в адресах: пробелы заменяются подчёркиваниями, первая буква — заглавная.
+    """
+    title = title.strip().replace(' ', '_')
+    return title[:1].upper() + title[1:]
+
+
+def extract_wikilinks(text):
+    """
+    Функция возвращает множество ссылок [[...]] на другие статьи из
+    вики-разметки text, без ссылок на служебные страницы и якоря.
+    """
+    return set(filter(None, map(normalize, WIKILINK.findall(text))))
+
+
+def open_dump(filename):
+    """
+    Функция открывает выгрузку на чтение в двоичном режиме, распаковывая
+    её, если она сжата gzip или bzip2.
+    """
+    if filename.endswith('.bz2'):
+        return bz2.open(filename)
+    if filename.endswith('.gz'):
+        return gzip.open(filename)
+    return open(filename, 'rb')
+
+
+def read_xml_dump(filename):
+    """
+    Генератор пар (название, множество ссылок) по статьям XML-выгрузки
+    MediaWiki (pages-articles.xml). Выгрузка читается потоком: разобранные
+    страницы удаляются из корня, так что память не растёт с размером
+    выгрузки. Служебные страницы пропускаются.
+    """
+    with open_dump(filename) as f:
+        root = None
+        for event, element in ElementTree.iterparse(f, ('start', 'end')):
+            if root is None:
+                root = element
+            if event != 'end' or element.tag.rpartition('}')[2] != 'page':
+                continue
+
+            fields = {child.tag.rpartition('}')[2]: child
+                      for child in element.iter()}
+            namespace = fields.get('ns')
+            if namespace is None or namespace.text == '0':
+                text = fields['text'].text if 'text' in fields else None
+                yield (normalize(fields['title'].text),
+                       extract_wikilinks(text or ''))
+            root.clear()
+
+
+def read_html_dump(directory):
+    """
+    Генератор пар (название, множество ссылок) по HTML-выгрузке: каталогу
+    файлов вида <название в адресе>.html. Ссылки извлекаются так же, как
+    при поиске по сети (extract_content и extract_links).
+    """
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.endswith('.html'):
+                continue
+            with open(os.path.join(root, name), encoding='utf-8',
+                      errors='ignore') as f:
+                text = f.read()
+            yield (unquote(name[:-len('.html')]),
+                   extract_links(text, *extract_content(text)))
+
+
+def to_csr(count, sources, targets):
+    """
+    Функция группирует рёбра sources[i] -> targets[i] по началу и
+    возвращает пару массивов int32 (смещения, концы рёбер).
+    """
+    offsets = array('i', bytes(4 * (count + 1)))
+    for source in sources:
+        offsets[source + 1] += 1
+    for node in range(count):
+        offsets[node + 1] += offsets[node]
+
+    position = array('i', offsets[:-1])
+    result = array('i', bytes(4 * len(targets)))
+    for source, target in zip(sources, targets):
+        result[position[source]] = target
+        position[source] += 1
+    return offsets, result
+
+
+def build(pages, filename):
+    """
+    Функция строит граф по парам (название, ссылки) pages и записывает его
+    в filename. Номера страниц соответствуют порядку названий, так что
+    название ищется в таблице двоичным поиском.
+    """
+    ids = dict()
+    sources = array('i')
+    targets = array('i')
+    for title, links in pages:
+        source = ids.setdefault(title, len(ids))
+        for link in links:
+            sources.append(source)
+            targets.append(ids.setdefault(link, len(ids)))
+    if len(targets) > INT32_MAX:
+        raise ValueError('слишком много ссылок для int32: {}'.format(
+            len(targets)))
+
+    titles = sorted(ids)
+    rank = array('i', bytes(4 * len(titles)))
+    for number, title in enumerate(titles):
+        rank[ids[title]] = number
+    sources = array('i', (rank[source] for source in sources))
+    targets = array('i', (rank[target] for target in targets))
+
+    names = [title.encode() for title in titles]
+    name_offsets = array('q', [0])
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+
+    sections = (to_csr(len(titles), sources, targets) +
+                to_csr(len(titles), targets, sources) +
+                (name_offsets, b''.join(names)))
+    with open(filename, 'wb') as f:
+        f.write(GRAPH_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, len(titles),
+                                  len(targets)))
+        for section in sections:
+            f.write(bytes(-f.tell() % 8))
+            f.write(section)
+    return len(titles), len(targets)
+
+
+class LinkGraph(object):
+    """
+    Граф ссылок, отображённый в память из файла, записанного build.
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = buffer = memoryview(self.map)
+        magic, version, nodes, edges = GRAPH_HEADER.unpack_from(buffer)
+        if (magic, version) != (GRAPH_MAGIC, GRAPH_VERSION):
+            raise ValueError('{}: не файл графа ссылок'.format(filename))
+
+        views = []
+        position = GRAPH_HEADER.size
+        for size in (4 * (nodes + 1), 4 * edges, 4 * (nodes + 1),
+                     4 * edges, 8 * (nodes + 1)):
+            position += -position % 8
+            views.append(buffer[position:position + size])
+            position += size
+        position += -position % 8
+        (self.offsets, self.targets, self.reverse_offsets,
+         self.sources) = (view.cast('i') for view in views[:4])
+        self.name_offsets = views[4].cast('q')
+        self.names = buffer[position:position + self.name_offsets[-1]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def close(self):
+        """
+        Освобождает отображение файла.
+        """
+        for view in (self.offsets, self.targets, self.reverse_offsets,
+                     self.sources, self.name_offsets, self.names,
+                     self.buffer):
+            view.release()
+        self.map.close()
+
+    def title(self, node):
+        """
+        Название страницы с номером node.
+        """
+        return bytes(self.names[self.name_offsets[node]:
+                                self.name_offsets[node + 1]]).decode()
+
+    def name(self, node):
+        """
+        Название страницы с номером node в байтах UTF-8, в том же порядке
+        сортировки, что и строки.
+        """
+        return self.names[self.name_offsets[node]:
+                          self.name_offsets[node + 1]].tobytes()
+
+    def node(self, title):
+        """
+        Номер страницы title или None, если её нет в графе.
+        """
+        name = title.encode()
+        node = bisect_left(range(len(self)), name, key=self.name)
+        if node < len(self) and self.name(node) == name:
+            return node
+        return None
+
+    def successors(self, node):
+        """
+        Номера страниц, на которые ссылается node.
+        """
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def predecessors(self, node):
+        """
+        Номера страниц, которые ссылаются на node.
+        """
+        return self.sources[self.reverse_offsets[node]:
+                            self.reverse_offsets[node + 1]]
+
+    def links_from(self, title):
+        """
+        Множество ссылок со страницы title или None, если её нет в графе.
+        """
+        node = self.node(title)
+        if node is None:
+            return None
+        return set(map(self.title, self.successors(node)))
+
+    def links_to(self, title):
+        """
+        Множество страниц, ссылающихся на title.
+        """
+        node = self.node(title)
+        if node is None:
+            return set()
+        return set(map(self.title, self.predecessors(node)))
+
+    def find_chain(self, start, finish):
+        """
+        Кратчайшая цепочка переходов от start до finish (двусторонний поиск
+        в ширину по прямым и обратным ссылкам) или None.
+        """
+        first, last = self.node(start), self.node(finish)
+        if first is None or last is None:
+            return None
+        if first == last:
+            return [start, finish]
+
+        previous = {first: -1}
+        following = {last: -1}
+        forward = [first]
+        backward = [last]
+        while forward and backward:
+            level = []
+            meetings = []
+            if len(backward) < len(forward):
+                for current in backward:
+                    for node in self.predecessors(current):
+                        if node not in following:
+                            following[node] = current
+                            level.append(node)
+                            if node in previous:
+                                meetings.append(node)
+                backward = level
+            else:
+                for current in forward:
+                    for node in self.successors(current):
+                        if node not in previous:
+                            previous[node] = current
+                            level.append(node)
+                            if node in following:
+                                meetings.append(node)
+                forward = level
+
+            if meetings:
+                return self.join(min(meetings, key=lambda node: (
+                    self.distance(node, previous) +
+                    self.distance(node, following))), previous, following)
+
+        return None
+
+    @staticmethod
+    def distance(node, steps):
+        """
+        Число переходов от node до конца цепочки steps.
+        """
+        count = 0
+        while steps[node] != -1:
+            node = steps[node]
+            count += 1
+        return count
+
+    def join(self, middle, previous, following):
+        """
+        Склеивает цепочку из двух половин, встретившихся в middle.
+        """
+        chain = []
+        node = middle
+        while node != -1:
+            chain.append(node)
+            node = previous[node]
+        chain.reverse()
+        node = following[middle]
+        while node != -1:
+            chain.append(node)
+            node = following[node]
+        return [self.title(node) for node in chain]
+
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Граф ссылок Википедии по локальной выгрузке.')
+    commands = arguments.add_subparsers(dest='command', required=True)
+    builder = commands.add_parser(
+        'build', help='построить граф по выгрузке')
+    builder.add_argument('dump', help='XML-выгрузка MediaWiki (в том числе '
+                                      'сжатая) или каталог HTML-страниц')
+    builder.add_argument('graph', help='куда записать граф')
+    builder.add_argument('--html', action='store_true',
+                         help='выгрузка — каталог HTML-страниц')
+    chains = commands.add_parser(
+        'chain', help='искать цепочки для пар названий из stdin, по паре '
+                      'через табуляцию в строке')
+    chains.add_argument('graph')
+    args = arguments.parse_args()
+
+    if args.command == 'build':
+        pages = (read_html_dump if args.html else read_xml_dump)(args.dump)
+        print('{} страниц, {} ссылок'.format(*build(pages, args.graph)),
+              file=sys.stderr)
+        return
+
+    with LinkGraph(args.graph) as graph:
+        for line in sys.stdin:
+            start, _, finish = line.rstrip('\n').partition('\t')
+            chain = graph.find_chain(start, finish)
+            print(' '.join(chain) if chain else '')
+
+
+if __name__ == '__main__':
+    main()
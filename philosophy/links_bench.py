@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Сравнение скорости извлечения ссылок: прежние extract_content и
+extract_links (повторная компиляция выражения, копия содержимого, unquote
+для каждой ссылки), новые extract_content и extract_links и разбор по частям
+LinkScanner. Страницы берутся из файлов или генерируются.
+Использование: links_bench.py [-n повторов] [файлы страниц]
+"""
+from urllib.parse import quote, unquote
+import argparse
+import random
+import re
+import time
+
+from phil import CHUNK, LinkScanner, extract_content, extract_links
+
+
+def legacy_links(page):
+    """Извлечение ссылок так, как оно было сделано до LinkScanner."""
+    start = page.find('<div id="mw-content-text"') \
+        if '<div id="mw-content-text"' in page else 0
+    finish = page.find('<div id="footer"') if '<div id="footer"' in page else 0
+    return set(map(unquote, re.findall('''<a +href=["']/wiki/([^#:]+?)["']''',
+                                       page[start:finish],
+                                       flags=re.I | re.M | re.U)))
+
+
+def current_links(page):
+    return extract_links(page, *extract_content(page))
+
+
+def scanner_links(page):
+    scanner = LinkScanner()
+    for start in range(0, len(page), CHUNK):
+        scanner.feed(page[start:start + CHUNK])
+        if scanner.done:
+            break
+    scanner.feed('', final=True)
+    return scanner.links()
+
+
+def make_page(seed, links=5000, titles=1500):
+    """Страница размером около мегабайта, похожая на статью Википедии:
+    шапка, содержимое со ссылками (многие повторяются, как в навигационных
+    шаблонах) и подвал."""
+    rng = random.Random(seed)
+    names = [quote('Статья_{}_{}'.format(seed, number))
+             for number in range(titles)]
+    body = []
+    for _ in range(links):
+        body.append('<p>{}</p><a href="/wiki/{}" title="x">ссылка</a>'.format(
+            'текст ' * rng.randrange(5, 40), rng.choice(names)))
+        if rng.random() < 0.1:
+            body.append('<a href="/wiki/Файл:{}.png">'.format(rng.random()))
+    return ('<html><head>' + 'мета ' * 2000 + '</head>'
+            '<div id="mw-content-text">' + ''.join(body) +
+            '</div><div id="footer">' + '<a href="/wiki/Подвал">' * 500 +
+            '</div></html>')
+
+
+def measure(function, pages, repeat):
+    """Возвращает скорость разбора в мегабайтах в секунду."""
+    size = sum(len(page.encode()) for page in pages) * repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            function(page)
+    return size / (time.perf_counter() - start) / 2 ** 20
+
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Скорость извлечения ссылок со страниц.')
+    arguments.add_argument('files', nargs='*', metavar='file')
+    arguments.add_argument('-n', '--repeat', type=int, default=5)
+    args = arguments.parse_args()
+
+    if args.files:
+        pages = []
+        for name in args.files:
+            with open(name, encoding='utf-8', errors='ignore') as f:
+                pages.append(f.read())
+    else:
+        pages = [make_page(seed) for seed in range(4)]
+
+    for page in pages:
+        assert legacy_links(page) == current_links(page) == \
+            scanner_links(page)
+    for name, function in (('legacy', legacy_links),
+                           ('extract_links', current_links),
+                           ('LinkScanner', scanner_links)):
+        print('{:>13}: {:>8,.1f} MB/sec'.format(
+            name, measure(function, pages, args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Дисковый кэш вики-страниц и ссылок с них для phil.find_chain. Записи
+хранятся сжатыми в базе SQLite, устаревают через ttl секунд, а при
+превышении max_size байт вытесняются давно не использованные. Базой могут
+одновременно пользоваться несколько процессов.
+"""
+import sqlite3
+import threading
+import time
+import zlib
+
+
+TTL = 7 * 24 * 60 * 60
+MAX_SIZE = 256 * 1024 * 1024
+TIMEOUT = 30.0
+PAGE = 'page'
+LINKS = 'links'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    stored REAL NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    entries INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals
+    SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM entries;
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE totals SET entries = entries + 1, size = size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE totals SET entries = entries - 1, size = size - old.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries
+BEGIN
+    UPDATE totals SET size = size - old.size + new.size;
+END;
+'''
+
+
+class PageCache(object):
+    """
+    Кэш содержимого страниц (по адресу) и множеств ссылок с них (по
+    названию статьи). Считает попадания, промахи и вытеснения в этом
+    процессе. Число записей и их общий размер поддерживаются триггерами
+    в таблице totals в той же транзакции, что и изменения, поэтому
+    проверка размера при записи не просматривает всю таблицу.
+    """
+    def __init__(self, path, ttl=TTL, max_size=MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=TIMEOUT,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript('BEGIN IMMEDIATE;' + SCHEMA + 'COMMIT;')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Закрывает базу.
+        """
+        with self.lock:
+            self.db.close()
+
+    def get(self, kind, key):
+        """
+        Возвращает сохранённые данные или None, если записи нет или она
+        устарела. Отмечает запись как использованную.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data, stored FROM entries WHERE kind = ? AND key = ?',
+                (kind, key)).fetchone()
+            if row is None or row[1] + self.ttl <= now:
+                self.misses += 1
+                if row is not None:
+                    self.db.execute(
+                        'DELETE FROM entries WHERE kind = ? AND key = ? '
+                        'AND stored = ?', (kind, key, row[1]))
+                return None
+
+            self.hits += 1
+            self.db.execute(
+                'UPDATE entries SET used = ? WHERE kind = ? AND key = ?',
+                (now, kind, key))
+        return zlib.decompress(row[0]).decode()
+
+    def put(self, kind, key, text):
+        """
+        Сохраняет text, вытесняя давно не использованные записи, если
+        кэш стал больше max_size.
+        """
+        data = zlib.compress(text.encode())
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute(
+                    'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (kind, key) DO UPDATE SET data = '
+                    'excluded.data, size = excluded.size, stored = '
+                    'excluded.stored, used = excluded.used',
+                    (kind, key, data, len(data), now, now))
+                self.evict()
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def evict(self):
+        """
+        Удаляет самые давно использованные записи, пока размер кэша больше
+        max_size. Вызывается внутри транзакции.
+        """
+        excess = self.db.execute(
+            'SELECT size FROM totals').fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+
+        victims = []
+        for kind, key, size in self.db.execute(
+                'SELECT kind, key, size FROM entries ORDER BY used'):
+            victims.append((kind, key))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany('DELETE FROM entries WHERE kind = ? AND key = ?',
+                            victims)
+        self.evictions += len(victims)
+
+    def get_page(self, url):
+        """
+        Содержимое страницы url или None.
+        """
+        return self.get(PAGE, url)
+
+    def put_page(self, url, text):
+        """
+        Сохраняет содержимое страницы url.
+        """
+        self.put(PAGE, url, text)
+
+    def get_links(self, name):
+        """
+        Множество ссылок со статьи name или None.
+        """
+        text = self.get(LINKS, name)
+        if text is None:
+            return None
+        return set(text.split('\n')) if text else set()
+
+    def put_links(self, name, links):
+        """
+        Сохраняет множество ссылок со статьи name.
+        """
+        self.put(LINKS, name, '\n'.join(sorted(links)))
+
+    def stats(self):
+        """
+        Возвращает словарь со статистикой: попадания, промахи и вытеснения
+        в этом процессе, число записей и их общий размер в байтах.
+        """
+        with self.lock:
+            entries, size = self.db.execute(
+                'SELECT entries, size FROM totals').fetchone()
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': entries,
+                'size': size}
@@ -1,20 +1,43 @@
 #!/usr/bin/env python3
 from urllib.request import urlopen
-from urllib.parse import quote, unquote
+from urllib.parse import quote, unquote, urlsplit
 from urllib.error import URLError, HTTPError
+from concurrent.futures import ThreadPoolExecutor
 from collections import deque
+import codecs
 import re
+import threading
 
 
-def get_content(name):
+WIKI = 'https://ru.wikipedia.org/wiki/'
+PER_HOST = 4
+CHUNK = 64 * 1024
+CONTENT = '<div id="mw-content-text"'
+FOOTER = '<div id="footer"'
+LINK = re.compile('''<a +href=["']/wiki/([^#:]+?)["']''',
+                  flags=re.I | re.M | re.U)
+LINK_START = re.compile('''<a +href=["']/wiki/''', flags=re.I)
+LINK_STOP = re.compile('[#:]')
+
+
+def get_content(name, cache=None):
     """
     Функция возвращает содержимое вики-страницы name из русской Википедии.
     В случае ошибки загрузки или отсутствия страницы возвращается None.
+    Если задан кэш cache (pagecache.PageCache), страница сначала ищется
+    в нём, а загруженная страница сохраняется в него.
     """
+    if cache is not None:
+        text = cache.get_page(name)
+        if text is not None:
+            return text
     try:
-        return urlopen(name).read().decode()
+        text = urlopen(name).read().decode()
     except (URLError, HTTPError):
         return None
+    if cache is not None:
+        cache.put_page(name, text)
+    return text
 
 
 def extract_content(page):
@@ -25,10 +48,7 @@ def extract_content(page):
     содержимое статьи.
     Если содержимое отсутствует, возвращается (0, 0).
     """
-    start = page.find('<div id="mw-content-text"') \
-        if '<div id="mw-content-text"' in page else 0
-    finish = page.find('<div id="footer"') if '<div id="footer"' in page else 0
-    return start, finish
+    return max(page.find(CONTENT), 0), max(page.find(FOOTER), 0)
 
 
 def extract_links(page, begin, end):
@@ -37,20 +57,278 @@ def extract_links(page, begin, end):
     задающего позицию содержимого статьи на странице и возвращает все имеющиеся
     ссылки на другие вики-страницы без повторений и с учётом регистра.
     """
-    return set(map(unquote, re.findall('''<a +href=["']/wiki/([^#:]+?)["']''',
-                                       page[begin:end],
-                                       flags=re.I | re.M | re.U)))
+    return set(map(unquote, set(LINK.findall(page, begin, end))))
+
+
+class LinkScanner(object):
+    """
+    Извлекает ссылки из страницы по частям, по мере её загрузки; результат
+    тот же, что у extract_links(page, *extract_content(page)). Уже
+    просмотренный текст не хранится: остаётся только хвост, в котором может
+    продолжиться незаконченная ссылка или метка, — от начала первой ссылки,
+    адрес которой ещё не закрыт кавычкой и не оборван '#' или ':' (адрес
+    может содержать и '<'), или от последнего '<'. Когда найдены обе
+    метки, done становится True и дальше страницу можно не загружать.
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.offset = 0
+        self.begin = None
+        self.end = None
+        self.found = []
+
+    @property
+    def done(self):
+        return self.begin is not None and self.end is not None
+
+    def locate(self, marker, start):
+        """
+        Возвращает абсолютную позицию метки marker в буфере, начиная поиск
+        с позиции start в буфере, или None.
+        """
+        position = self.buffer.find(marker, max(start, 0))
+        return None if position < 0 else self.offset + position
+
+    def feed(self, chunk, final=False):
+        """
+        Обрабатывает очередную часть страницы. final — это последняя часть.
+        """
+        if self.done:
+            return
+        start = len(self.buffer)
+        self.buffer += chunk
+        if self.begin is None:
+            self.begin = self.locate(CONTENT, start - len(CONTENT))
+            if self.begin is not None:
+                self.found = [(position, link) for position, link
+                              in self.found if position >= self.begin]
+        if self.end is not None:
+            # Содержимое закончилось, но метку начала ещё надо найти:
+            # если она стоит после конца, ссылок нет.
+            cut = max(len(self.buffer) - len(CONTENT), 0)
+            self.buffer = self.buffer[cut:]
+            self.offset += cut
+            return
+
+        self.end = self.locate(FOOTER, start - len(FOOTER))
+        if self.end is not None:
+            cut = self.end - self.offset
+        else:
+            cut = len(self.buffer)
+        scan = 0 if self.begin is None else \
+            max(self.begin - self.offset, 0)
+        last = scan
+        for match in LINK.finditer(self.buffer, scan, cut):
+            self.found.append((self.offset + match.start(), match.group(1)))
+            last = match.end()
+        if self.end is None and not final:
+            cut = self.pending(last)
+        self.buffer = '' if self.done else self.buffer[cut:]
+        self.offset += cut
+
+    def pending(self, start):
+        """
+        Возвращает позицию в буфере, начиная с которой текст надо
+        сохранить до следующей части: начало первой после start ссылки,
+        которая ещё может закончиться, или последний '<', с которого может
+        начинаться метка или ссылка, или конец буфера.
+        """
+        last = self.buffer.rfind('<', start)
+        if last < 0:
+            return len(self.buffer)
+        for match in LINK_START.finditer(self.buffer, start, last):
+            if not LINK_STOP.search(self.buffer, match.end()):
+                return match.start()
+        return last
+
+    def links(self):
+        """
+        Возвращает множество найденных ссылок. Если метки конца
+        содержимого нет или она стоит раньше начала, ссылок нет.
+        """
+        if self.end is None or (self.begin or 0) > self.end:
+            return set()
+        begin = self.begin or 0
+        return set(map(unquote, {link for position, link in self.found
+                                 if position >= begin}))
+
+
+def page_url(name, base=WIKI):
+    """
+    Функция возвращает адрес вики-страницы name относительно base.
+    """
+    return base + quote(name, safe=':/')
+
+
+def fetch_links(name):
+    """
+    Функция загружает вики-страницу name по частям, извлекая ссылки по мере
+    загрузки (см. LinkScanner), и возвращает множество ссылок или None,
+    если страницу не удалось загрузить. Загрузка прекращается, как только
+    содержимое статьи закончилось.
+    """
+    scanner = LinkScanner()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with urlopen(name) as response:
+            empty = True
+            while not scanner.done:
+                chunk = response.read(CHUNK)
+                scanner.feed(decoder.decode(chunk, final=not chunk),
+                             final=not chunk)
+                if not chunk:
+                    break
+                empty = False
+    except (URLError, HTTPError):
+        return None
+    if empty:
+        return None
+    return scanner.links()
+
+
+def get_links(name, base=WIKI, cache=None, fetch=fetch_links):
+    """
+    Функция возвращает множество ссылок со статьи name или None, если её
+    не удалось загрузить. Ссылки извлекаются функцией fetch от адреса
+    статьи; если задан кэш cache, они сначала ищутся в нём, а найденные
+    сохраняются в него.
+    """
+    if cache is not None:
+        links = cache.get_links(name)
+        if links is not None:
+            return links
+    links = fetch(page_url(name, base))
+    if links is None:
+        return None
+    if cache is not None:
+        cache.put_links(name, links)
+    return links
+
+
+class LinkIndex(object):
+    """
+    Прямые и обратные ссылки между вики-страницами. Индекс заполняется из
+    локальной выгрузки страниц (from_pages) и страницами, загруженными во
+    время поиска, так что повторные запросы обходятся без загрузок.
+    """
+    def __init__(self):
+        self.forward = dict()
+        self.backward = dict()
+
+    @classmethod
+    def from_pages(cls, pages):
+        """
+        Строит индекс по парам (название, содержимое страницы).
+        """
+        index = cls()
+        for name, text in pages:
+            index.add_page(name, text)
+        return index
+
+    def add(self, name, links):
+        """
+        Запоминает, что со страницы name есть ссылки links.
+        """
+        for link in self.forward.get(name, ()):
+            self.backward[link].discard(name)
+        self.forward[name] = set(links)
+        for link in self.forward[name]:
+            self.backward.setdefault(link, set()).add(name)
+
+    def add_page(self, name, text):
+        """
+        Добавляет ссылки из содержимого страницы name.
+        """
+        self.add(name, extract_links(text, *extract_content(text)))
+
+    def links_from(self, name):
+        """
+        Ссылки со страницы name или None, если страница не известна.
+        """
+        return self.forward.get(name)
+
+    def links_to(self, name):
+        """
+        Известные страницы, ссылающиеся на name.
+        """
+        return self.backward.get(name, ())
+
+
+class Fetcher(object):
+    """
+    Загружает страницы в пуле из workers потоков. Одновременно к одному
+    серверу выполняется не больше per_host запросов. Ссылки, найденные
+    в кэше cache, берутся из него без загрузки.
+    """
+    def __init__(self, workers, per_host=PER_HOST, cache=None):
+        self.executor = ThreadPoolExecutor(workers)
+        self.per_host = per_host
+        self.cache = cache
+        self.limits = dict()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def limit(self, url):
+        """
+        Возвращает семафор, ограничивающий запросы к серверу адреса url.
+        """
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.limits:
+                self.limits[host] = threading.Semaphore(self.per_host)
+            return self.limits[host]
+
+    def fetch(self, url):
+        """
+        Загружает страницу url с учётом ограничения на сервер.
+        """
+        with self.limit(url):
+            return fetch_links(url)
+
+    def links(self, names, base=WIKI):
+        """
+        Загружает статьи names параллельно и возвращает множества ссылок
+        с них (см. get_links) в том же порядке.
+        """
+        return self.executor.map(
+            lambda name: get_links(name, base, self.cache, self.fetch), names)
 
+    def close(self):
+        """
+        Останавливает потоки, отменяя ещё не начатые загрузки.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
-def find_chain(start, finish):
+
+def find_chain(start, finish, workers=None, per_host=PER_HOST, base=WIKI,
+               index=None, cache=None, graph=None):
     """
     Функция принимает на вход название начальной и конечной статьи и возвращает
     список переходов, позволяющий добраться из начальной статьи в конечную.
     Первым элементом результата должен быть start, последним — finish.
     Если построить переходы невозможно, возвращается None.
+    Если задано workers, страницы загружаются параллельно (см.
+    find_chain_concurrent). base — адрес, относительно которого строятся
+    адреса статей. Если задан индекс ссылок index, поиск идёт с двух концов
+    (см. find_chain_bidirectional). Ссылки со статей берутся из кэша cache
+    (pagecache.PageCache), если он задан. Если задан граф ссылок graph
+    (linkgraph.LinkGraph), цепочка ищется только по нему, без загрузок.
     """
     if start == finish:
         return [start, finish]
+    if graph is not None:
+        return graph.find_chain(start, finish)
+    if index is not None:
+        return find_chain_bidirectional(start, finish, index, workers,
+                                        per_host, base, cache)
+    if workers:
+        return find_chain_concurrent(start, finish, workers, per_host, base,
+                                     cache)
 
     visited = set()
     to_visit = deque()
@@ -60,12 +338,10 @@ def find_chain(start, finish):
     while len(to_visit) != 0:
         current = to_visit.pop()
         visited.add(current)
-        text = get_content('https://ru.wikipedia.org/wiki/' +
-                           quote(current, safe=':/'))
-        if not text:
+        new_links = get_links(current, base, cache)
+        if new_links is None:
             return None
 
-        new_links = extract_links(text, *extract_content(text))
         for link in new_links:
             if link not in visited:
                 to_visit.appendleft(link)
@@ -77,6 +353,122 @@ def find_chain(start, finish):
     return None
 
 
+def find_chain_concurrent(start, finish, workers, per_host=PER_HOST,
+                          base=WIKI, cache=None):
+    """
+    Поиск в ширину по уровням: все статьи очередного уровня загружаются
+    параллельно в workers потоках (не больше per_host одновременных запросов
+    к одному серверу), а ссылки разбираются в порядке уровня. Поэтому,
+    как и при последовательном поиске, найденная цепочка кратчайшая.
+    Статьи, которые не удалось загрузить, пропускаются; если не загрузилась
+    начальная статья, возвращается None.
+    """
+    previous = {start: None}
+    level = [start]
+
+    with Fetcher(workers, per_host, cache) as fetcher:
+        while level:
+            next_level = []
+            for current, links in zip(level, fetcher.links(level, base)):
+                if links is None:
+                    if current == start:
+                        return None
+                    continue
+
+                for link in links:
+                    if link not in previous:
+                        previous[link] = current
+                        next_level.append(link)
+
+                        if link == finish:
+                            return build_path(start, finish, previous)
+            level = next_level
+
+    return None
+
+
+def crawl(fetcher, names, index, base=WIKI):
+    """
+    Функция возвращает список множеств ссылок со статей names (None для
+    статей, которые не удалось загрузить). Ссылки известных индексу статей
+    берутся из него, остальные статьи загружаются параллельно и добавляются
+    в индекс.
+    """
+    missing = [name for name in names if index.links_from(name) is None]
+    for name, links in zip(missing, fetcher.links(missing, base)):
+        if links is not None:
+            index.add(name, links)
+    return [index.links_from(name) for name in names]
+
+
+def find_chain_bidirectional(start, finish, index, workers=None,
+                             per_host=PER_HOST, base=WIKI, cache=None):
+    """
+    Двусторонний поиск в ширину: от start по ссылкам со страниц и от finish
+    по обратным ссылкам из индекса index. На каждом шаге расширяется меньший
+    из двух фронтов целым уровнем. Страницы прямого фронта, которых нет в
+    индексе, загружаются (параллельно, если задано workers) и добавляются
+    в него; обратный фронт ничего не загружает и может расти, только пока
+    в индексе есть ссылки на его страницы. Среди встреч фронтов на уровне
+    выбирается дающая самую короткую цепочку; кратчайшей она будет среди
+    цепочек по известным индексу ссылкам.
+    """
+    previous = {start: None}
+    following = {finish: None}
+    forward = [start]
+    backward = [finish]
+
+    with Fetcher(workers or 1, per_host, cache) as fetcher:
+        while forward:
+            level = []
+            meetings = []
+            if backward and len(backward) <= len(forward):
+                for current in backward:
+                    for link in index.links_to(current):
+                        if link not in following:
+                            following[link] = current
+                            level.append(link)
+                            if link in previous:
+                                meetings.append(link)
+                backward = level
+            else:
+                for current, links in zip(forward,
+                                          crawl(fetcher, forward, index,
+                                                base)):
+                    if links is None:
+                        if current == start:
+                            return None
+                        continue
+
+                    for link in links:
+                        if link not in previous:
+                            previous[link] = current
+                            level.append(link)
+                            if link in following:
+                                meetings.append(link)
+                forward = level
+
+            if meetings:
+                middle = min(meetings,
+                             key=lambda name: distance(name, previous) +
+                             distance(name, following))
+                return build_path(start, middle, previous) + \
+                    build_path(finish, middle, following)[-2::-1]
+
+    return None
+
+
+def distance(name, steps):
+    """
+    Функция возвращает число переходов от name до конца цепочки steps.
+    """
+    count = 0
+    while steps[name] is not None:
+        name = steps[name]
+        count += 1
+    return count
+
+
 def build_path(start, finish, previous):
     answer = [finish]
     current = finish
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
 import phil as t
+from linkgraph import LinkGraph, build, read_html_dump, read_xml_dump
+from pagecache import PageCache
 from urllib.request import urlopen
-from urllib.parse import quote
+from urllib.parse import quote, unquote
 from urllib.error import URLError, HTTPError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
 
 
@@ -132,9 +141,364 @@ class TestChainFinder(unittest.TestCase):
         self._check('Самолёт')
 
 
+def _page(links):
+    return ('<html><div id="mw-content-text">' +
+            ''.join('<a href="/wiki/{}">{}</a>'.format(quote(link), link)
+                    for link in links) +
+            '</div><div id="footer"></div></html>')
+
+
+class TestLinkScanner(unittest.TestCase):
+    PAGES = [
+        _page(['A', 'Б_в', 'A']),
+        '<a href="/wiki/Before">' + _page(['A']) + '<a href="/wiki/After">',
+        '<a href="/wiki/A"><div id="footer"><a href="/wiki/B">',
+        '<div id="footer"><div id="mw-content-text"><a href="/wiki/A">',
+        '<div id="mw-content-text"><a href="/wiki/A">',
+        TestLinksExtractor.TEXT,
+        '',
+        '<div id="mw-content-text"><a href="/wiki/a<b"><div id="footer">',
+        '<div id="mw-content-text"><a href="/wiki/a#<b"><a href="/wiki/c<d'
+        '<e"> <A  HREF=\'/wiki/f:<g\'><a href=\'/wiki/h<\'<div id="footer">',
+    ]
+
+    def _scan(self, page, size):
+        scanner = t.LinkScanner()
+        for start in range(0, len(page), size):
+            scanner.feed(page[start:start + size])
+        scanner.feed('', final=True)
+        return scanner.links()
+
+    def test_same_as_extract_links(self):
+        rng = random.Random(3)
+        pages = self.PAGES + [_page(
+            ['Ссылка_{}'.format(rng.randrange(50)) for _ in range(300)])]
+        for page in pages:
+            expected = t.extract_links(page, *t.extract_content(page))
+            for size in (1, 2, 5, 7, 64, len(page) + 1):
+                self.assertEqual(self._scan(page, size), expected)
+
+    def test_done(self):
+        scanner = t.LinkScanner()
+        scanner.feed('<div id="mw-content-text"><a href="/wiki/A"><div id')
+        self.assertFalse(scanner.done)
+        scanner.feed('="footer"><a href="/wiki/B">')
+        self.assertTrue(scanner.done)
+        scanner.feed('<a href="/wiki/C">')
+        self.assertEqual(scanner.links(), {'A'})
+        self.assertEqual(scanner.buffer, '')
+
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        name = unquote(self.path[len('/wiki/'):])
+        with server.lock:
+            server.requests.append(name)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            if name not in server.pages:
+                self.send_error(404)
+                return
+            body = _page(server.pages[name]).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class _FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, pages, delay=0.0):
+        super().__init__(('127.0.0.1', 0), _FixtureHandler)
+        self.pages = pages
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.base = 'http://127.0.0.1:{}/wiki/'.format(self.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class TestConcurrentChainFinder(unittest.TestCase):
+    PAGES = {
+        'Начало': ['Длинный_путь', 'Короткий путь', 'Нет_такой'],
+        'Длинный_путь': ['Б1'],
+        'Б1': ['Б2'],
+        'Б2': [PHIL],
+        'Короткий путь': ['А1', 'Начало'],
+        'А1': [PHIL],
+        PHIL: ['Начало'],
+        'Тупик': ['Тупик'],
+    }
+
+    def _find(self, begin, workers=4, per_host=2):
+        with _FixtureServer(self.PAGES) as server:
+            return t.find_chain(begin, PHIL, workers, per_host, server.base)
+
+    def test_shortest_chain(self):
+        self.assertEqual(self._find('Начало'),
+                         ['Начало', 'Короткий путь', 'А1', PHIL])
+
+    def test_same_as_sequential(self):
+        with _FixtureServer(self.PAGES) as server:
+            sequential = t.find_chain('Длинный_путь', PHIL, base=server.base)
+        self.assertEqual(self._find('Длинный_путь'), sequential)
+
+    def test_no_chain(self):
+        self.assertIsNone(self._find('Тупик'))
+
+    def test_missing_start(self):
+        self.assertIsNone(self._find('Нет_такой'))
+
+    def test_per_host_limit(self):
+        pages = {'Начало': ['Страница_{}'.format(i) for i in range(12)]}
+        with _FixtureServer(pages, delay=0.05) as server:
+            self.assertIsNone(t.find_chain('Начало', PHIL, workers=8,
+                                           per_host=3, base=server.base))
+        self.assertEqual(len(server.requests), 13)
+        self.assertLessEqual(server.max_active, 3)
+        self.assertGreater(server.max_active, 1)
+
+
+class TestBidirectionalChainFinder(unittest.TestCase):
+    PAGES = TestConcurrentChainFinder.PAGES
+    SHORTEST = ['Начало', 'Короткий путь', 'А1', PHIL]
+
+    def _index(self, skip=()):
+        return t.LinkIndex.from_pages((name, _page(links))
+                                      for name, links in self.PAGES.items()
+                                      if name not in skip)
+
+    def test_index(self):
+        index = self._index()
+        self.assertEqual(index.links_from('Б1'), {'Б2'})
+        self.assertEqual(set(index.links_to(PHIL)), {'Б2', 'А1'})
+        self.assertIsNone(index.links_from('Нет_такой'))
+        index.add('Б1', ['А1'])
+        self.assertEqual(set(index.links_to(PHIL)), {'Б2', 'А1'})
+        self.assertEqual(set(index.links_to('Б2')), set())
+        self.assertEqual(set(index.links_to('А1')), {'Короткий путь', 'Б1'})
+
+    def test_dump_index(self):
+        with _FixtureServer(self.PAGES) as server:
+            chain = t.find_chain('Начало', PHIL, base=server.base,
+                                 index=self._index())
+        self.assertEqual(chain, self.SHORTEST)
+        self.assertEqual(server.requests, [])
+
+    def test_backward_side(self):
+        with _FixtureServer(self.PAGES) as server:
+            chain = t.find_chain('Начало', PHIL, base=server.base,
+                                 index=self._index(skip=('Начало',)))
+        self.assertEqual(chain, self.SHORTEST)
+        self.assertEqual(server.requests, ['Начало'])
+
+    def test_crawled_index(self):
+        index = t.LinkIndex()
+        with _FixtureServer(self.PAGES) as server:
+            first = t.find_chain('Длинный_путь', PHIL, workers=2,
+                                 base=server.base, index=index)
+            fetched = len(server.requests)
+            second = t.find_chain('Длинный_путь', PHIL, base=server.base,
+                                  index=index)
+        self.assertEqual(first, ['Длинный_путь', 'Б1', 'Б2', PHIL])
+        self.assertEqual(second, first)
+        self.assertEqual(fetched, 3)
+        self.assertEqual(len(server.requests), fetched)
+
+    def test_no_chain(self):
+        with _FixtureServer(self.PAGES) as server:
+            self.assertIsNone(t.find_chain('Тупик', PHIL, base=server.base,
+                                           index=self._index()))
+            self.assertIsNone(t.find_chain('Нет_такой', PHIL,
+                                           base=server.base,
+                                           index=t.LinkIndex()))
+
+
+def _fill_cache(args):
+    path, number = args
+    with PageCache(path) as cache:
+        for i in range(50):
+            cache.put_links('{}_{}'.format(number, i), {'A', str(i)})
+            cache.get_links('{}_{}'.format((number + 1) % 4, i))
+        return cache.hits + cache.misses
+
+
+class TestPageCache(unittest.TestCase):
+    def _check_totals(self, cache):
+        stats = cache.stats()
+        self.assertEqual(
+            cache.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                             'FROM entries').fetchone(),
+            (stats['entries'], stats['size']))
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'pages.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_pages_and_links(self):
+        with PageCache(self.path) as cache:
+            self.assertIsNone(cache.get_page('http://x/wiki/A'))
+            cache.put_page('http://x/wiki/A', _page(['Б']))
+            cache.put_links('A', {'Б', 'В_г'})
+            cache.put_links('Пусто', set())
+            self.assertEqual(cache.get_page('http://x/wiki/A'), _page(['Б']))
+            self.assertEqual(cache.get_links('A'), {'Б', 'В_г'})
+            self.assertEqual(cache.get_links('Пусто'), set())
+            self.assertIsNone(cache.get_links('Б'))
+            stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']),
+                         (3, 2, 3))
+        with PageCache(self.path) as cache:
+            self.assertEqual(cache.get_links('A'), {'Б', 'В_г'})
+
+    def test_ttl(self):
+        with PageCache(self.path, ttl=0.05) as cache:
+            cache.put_links('A', {'Б'})
+            self.assertEqual(cache.get_links('A'), {'Б'})
+            time.sleep(0.1)
+            self.assertIsNone(cache.get_links('A'))
+            self.assertEqual(cache.stats()['entries'], 0)
+            self._check_totals(cache)
+
+    def test_lru(self):
+        pages = [str(random.Random(i).getrandbits(8000)) for i in range(4)]
+        with PageCache(self.path) as cache:
+            cache.put_page('0', pages[0])
+            cache.max_size = cache.stats()['size'] * 3 + 100
+            cache.put_page('1', pages[1])
+            cache.put_page('2', pages[2])
+            self.assertEqual(cache.get_page('0'), pages[0])
+            cache.put_page('3', pages[3])
+            self.assertIsNone(cache.get_page('1'))
+            for key in '023':
+                self.assertEqual(cache.get_page(key), pages[int(key)])
+            self.assertEqual(cache.stats()['evictions'], 1)
+            self._check_totals(cache)
+            cache.put_page('0', pages[0][:100])
+            self._check_totals(cache)
+
+    def test_processes(self):
+        with Pool(4) as pool:
+            self.assertEqual(pool.map(_fill_cache,
+                                      [(self.path, i) for i in range(4)]),
+                             [50] * 4)
+        with PageCache(self.path) as cache:
+            self.assertEqual(cache.stats()['entries'], 200)
+            self.assertEqual(cache.get_links('3_7'), {'A', '7'})
+            self._check_totals(cache)
+
+    def test_find_chain(self):
+        pages = TestConcurrentChainFinder.PAGES
+        with PageCache(self.path) as cache, _FixtureServer(pages) as server:
+            first = t.find_chain('Длинный_путь', PHIL, base=server.base,
+                                 cache=cache)
+            fetched = len(server.requests)
+            second = t.find_chain('Длинный_путь', PHIL, workers=2,
+                                  base=server.base, cache=cache)
+            self.assertEqual(second, first)
+            self.assertEqual(len(server.requests), fetched)
+            self.assertEqual(cache.stats()['hits'], fetched)
+
+
+class TestLinkGraph(unittest.TestCase):
+    PAGES = TestConcurrentChainFinder.PAGES
+    XML = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">
+<page><title>Начало</title><ns>0</ns><revision><text>
+[[Длинный путь]], [[короткий путь|путь]], [[Файл:Картинка.png]]
+</text></revision></page>
+<page><title>Короткий путь</title><ns>0</ns><revision><text>
+[[А1#История]] [[Начало]]</text></revision></page>
+<page><title>А1</title><ns>0</ns><revision><text>[[Философия]]
+</text></revision></page>
+<page><title>Обсуждение:А1</title><ns>1</ns><revision><text>[[Начало]]
+</text></revision></page>
+<page><title>Пустая</title><ns>0</ns><revision><text/></revision></page>
+</mediawiki>"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'links.graph')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _html_graph(self):
+        dump = os.path.join(self.directory.name, 'html')
+        os.mkdir(dump)
+        for name, links in self.PAGES.items():
+            with open(os.path.join(dump, quote(name) + '.html'), 'w',
+                      encoding='utf-8') as f:
+                f.write(_page(links))
+        build(read_html_dump(dump), self.path)
+        return LinkGraph(self.path)
+
+    def test_html_dump(self):
+        with self._html_graph() as graph:
+            self.assertEqual(len(graph), len(self.PAGES) + 1)
+            self.assertEqual(graph.find_chain('Начало', PHIL),
+                             ['Начало', 'Короткий путь', 'А1', PHIL])
+            self.assertEqual(graph.find_chain('Длинный_путь', PHIL),
+                             ['Длинный_путь', 'Б1', 'Б2', PHIL])
+            self.assertEqual(graph.find_chain('Б2', PHIL), ['Б2', PHIL])
+            self.assertIsNone(graph.find_chain('Тупик', PHIL))
+            self.assertIsNone(graph.find_chain('Нет_такой', 'Начало'))
+            self.assertIsNone(graph.find_chain('Неизвестная', PHIL))
+            self.assertEqual(graph.links_from('Начало'),
+                             set(self.PAGES['Начало']))
+            self.assertIsNone(graph.links_from('Неизвестная'))
+            self.assertEqual(graph.links_from('Нет_такой'), set())
+            self.assertEqual(graph.links_to('Начало'),
+                             {'Короткий путь', PHIL})
+
+    def test_find_chain(self):
+        with self._html_graph() as graph:
+            self.assertEqual(t.find_chain(PHIL, 'А1', graph=graph),
+                             [PHIL, 'Начало', 'Короткий путь', 'А1'])
+
+    def test_xml_dump(self):
+        dump = os.path.join(self.directory.name, 'pages.xml')
+        with open(dump, 'w', encoding='utf-8') as f:
+            f.write(self.XML)
+        self.assertEqual(dict(read_xml_dump(dump)), {
+            'Начало': {'Длинный_путь', 'Короткий_путь'},
+            'Короткий_путь': {'А1', 'Начало'},
+            'А1': {PHIL},
+            'Пустая': set()})
+        build(read_xml_dump(dump), self.path)
+        with LinkGraph(self.path) as graph:
+            self.assertEqual(graph.find_chain('Начало', PHIL),
+                             ['Начало', 'Короткий_путь', 'А1', PHIL])
+
+
 def make_suite():
     suite = unittest.TestSuite()
-    for test in (TestLinksExtractor, TestChainFinder):
+    for test in (TestLinksExtractor, TestLinkScanner, TestChainFinder,
+                 TestConcurrentChainFinder, TestBidirectionalChainFinder,
+                 TestPageCache, TestLinkGraph):
         suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(test))
     return suite
 